@@ -1,4 +1,5 @@
 from _datagen import get_dataset
+from label_the_sky.preprocessing.archive import CropArchive
 from pandas import read_csv
 import numpy as np
 import os
@@ -6,8 +7,8 @@ from skimage import io
 import sys
 
 
-if len(sys.argv) != 4:
-    print('usage: python {} <csv_file> <n_channels> <target>'.format(
+if len(sys.argv) not in [4, 5]:
+    print('usage: python {} <csv_file> <n_channels> <target> [<crop_archive>]'.format(
         sys.argv[0]))
     exit(1)
 
@@ -24,6 +25,7 @@ if target not in ['class', 'magnitudes']:
 base_dir = os.environ['DATA_PATH']
 data_dir = 'crops_rgb32' if n_channels==3 else 'crops_calib'
 data_dir = os.path.join(base_dir, data_dir)
+archive = CropArchive(sys.argv[4]) if len(sys.argv) == 5 else None
 output_dir = os.path.join(os.environ['HOME'], 'data')
 
 dataset_name = csv_file.split('/')[-1][:-4]
@@ -33,6 +35,13 @@ ext = '.png' if n_channels==3 else '.npy'
 
 df = read_csv(csv_file)
 
+# crops are kept unnormalized; loaders apply the bounds on read
+if archive is not None and archive.bounds is not None:
+    np.save(
+        os.path.join(output_dir, f'{dataset_name}_{n_channels}_bounds.npy'),
+        np.stack(archive.bounds))
+    print(f'saved {dataset_name}_{n_channels}_bounds.npy')
+
 for split in ['train', 'val', 'test']:
     df_tmp = df[(df.split==split)]
     ids, y, labels = get_dataset(df_tmp, target=target, n_bands=n_channels)
@@ -42,10 +51,13 @@ for split in ['train', 'val', 'test']:
             f'{dataset_name}_{n_channels}_y_{split}.npy'),
         y)
     print(f'saved {dataset_name}_{n_channels}_y_{split}.npy', y.shape)
-    im_paths = [os.path.join(data_dir, i.split('.')[0], i + ext) for i in ids]
-    X = np.zeros((len(ids),) + (32, 32, n_channels), dtype=dtype)
-    for i, path in enumerate(im_paths):
-        X[i, :] = read_fn(path)
+    if archive is not None:
+        X = archive.read(ids).astype(dtype)
+    else:
+        im_paths = [os.path.join(data_dir, i.split('.')[0], i + ext) for i in ids]
+        X = np.zeros((len(ids),) + (32, 32, n_channels), dtype=dtype)
+        for i, path in enumerate(im_paths):
+            X[i, :] = read_fn(path)
     np.save(
         os.path.join(
             output_dir,
@@ -5,6 +5,7 @@ from tensorflow.keras.utils import Sequence, to_categorical
 import os
 
 from label_the_sky.config import CLASS_MAP
+from label_the_sky.preprocessing.stats import normalize_batch
 
 def get_dataset(df, target='class', n_bands=12, filters=None):
     """
@@ -58,7 +59,14 @@ class DataGenerator(Sequence):
     def __init__(
             self, object_ids, data_folder, input_dim, target='classes',
             labels=None, batch_size=32, n_outputs=3, shuffle=True,
-            augmentation=True):
+            augmentation=True, archive=None, bounds=None):
+        # optional CropArchive: batches are read at once instead of per file
+        self.archive = archive
+        # optional (lower, upper) per-band bounds applied to each batch;
+        # defaults to the bounds stored in the archive, if any
+        if bounds is None and archive is not None:
+            bounds = archive.bounds
+        self.bounds = bounds
         self.batch_size = batch_size
         self.data_folder = data_folder
         self.labels = labels
@@ -73,6 +81,8 @@ class DataGenerator(Sequence):
         self.aug = self.compose_augment()
         self.extension = '.npy' if self.shape[2] > 3 else '.png'
         self.shape_orig = self.shape[:-1] + (12,)
+        if self.bounds is not None and self.bands is not None:
+            self.bounds = tuple(np.asarray(b)[self.bands] for b in self.bounds)
 
         self.on_epoch_end()
 
@@ -115,13 +125,23 @@ class DataGenerator(Sequence):
         X = np.empty((self.batch_size,) + self.shape)
         y = np.zeros((self.batch_size, self.n_outputs), dtype=np.float32)
 
+        if self.archive is not None:
+            ims = self.archive.read(list_ids_temp)
+            if self.extension == '.png':
+                # archives store RGB crops, while imread below gives BGR
+                ims = ims[..., ::-1] / 255.
+            elif self.bands is not None:
+                ims = ims[:, :, :, self.bands]
+
         for i, object_id in enumerate(list_ids_temp):
             filepath = os.path.join(
                 self.data_folder,
                 object_id.split('.')[0],
                 object_id + self.extension)
 
-            if self.extension == '.png':
+            if self.archive is not None:
+                im = ims[i]
+            elif self.extension == '.png':
                 im = imread(filepath)
                 im = im / 255.
             else:
@@ -138,6 +158,9 @@ class DataGenerator(Sequence):
             if self.labels is not None:
                 y[i, :] = self.labels[object_id]
 
+        if self.bounds is not None:
+            X = normalize_batch(X, *self.bounds)
+
         if self.labels is None:
             return X, None
 
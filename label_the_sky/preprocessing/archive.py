@@ -0,0 +1,325 @@
+import json
+import numpy as np
+import os
+from time import time
+import zlib
+
+from label_the_sky.preprocessing.stats import normalize_batch
+
+
+class CropArchive:
+    """
+    stores crops as a few append-only array files instead of one file per object
+    layout of folder:
+        * meta.json     shape and dtype of crops, plus optional metadata
+        * <shard>.dat   raw crops, one record after the other
+        * <shard>.ids   object ids of the shard, one per line, in record order
+
+    shards are named after fields (crop workers use <field>_<chunk>),
+    and any id is located through an in-memory id -> (shard, offset) index.
+    ids are written after their records, so the .ids file is authoritative:
+    records left over by an interrupted append are overwritten by the next one.
+    """
+
+    def __init__(self, folder, shape=None, dtype=None):
+        self.folder = folder
+        self.meta_file = os.path.join(folder, 'meta.json')
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as f:
+                self.meta = json.load(f)
+        else:
+            if shape is None or dtype is None:
+                raise ValueError('shape and dtype are required for a new archive')
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            self.meta = {'shape': list(shape), 'dtype': np.dtype(dtype).str}
+            self.save_meta()
+        self.shape = tuple(self.meta['shape'])
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.record_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._ids = {}
+        self._index = None
+
+    def save_meta(self):
+        tmp_file = self.meta_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_file, self.meta_file)
+
+    @property
+    def bounds(self):
+        """
+        returns the (bounds_lower, bounds_upper) normalization bounds stored
+        in the archive metadata, or None
+        """
+        if 'bounds_lower' not in self.meta:
+            return None
+        return np.array(self.meta['bounds_lower']), np.array(self.meta['bounds_upper'])
+
+    def set_bounds(self, bounds_lower, bounds_upper):
+        self.meta['bounds_lower'] = [float(b) for b in bounds_lower]
+        self.meta['bounds_upper'] = [float(b) for b in bounds_upper]
+        self.save_meta()
+
+    def shards(self):
+        return sorted(f[:-4] for f in os.listdir(self.folder) if f.endswith('.ids'))
+
+    def shard_ids(self, shard):
+        if shard not in self._ids:
+            ids_file = os.path.join(self.folder, shard + '.ids')
+            if os.path.exists(ids_file):
+                with open(ids_file) as f:
+                    self._ids[shard] = f.read().split()
+            else:
+                self._ids[shard] = []
+        return self._ids[shard]
+
+    def index(self):
+        """
+        returns a dict mapping each object id to its (shard, offset)
+        """
+        if self._index is None:
+            self._index = {}
+            for shard in self.shards():
+                for offset, object_id in enumerate(self.shard_ids(shard)):
+                    self._index[object_id] = (shard, offset)
+        return self._index
+
+    def __contains__(self, object_id):
+        return object_id in self.index()
+
+    def __len__(self):
+        return len(self.index())
+
+    def append(self, shard, ids, crops):
+        """
+        appends crops of the given object ids to a shard
+        receives:
+            * shard     (str) shard name, e.g., field name
+            * ids       (list) object ids, one per crop
+            * crops     (ndarray) (len(ids),) + shape array
+        """
+        crops = np.ascontiguousarray(crops, dtype=self.dtype)
+        if crops.shape != (len(ids),) + self.shape:
+            raise ValueError('expected crops of shape {}, but {} was given'.format(
+                (len(ids),) + self.shape, crops.shape))
+        shard_ids = self.shard_ids(shard)
+        data_file = os.path.join(self.folder, shard + '.dat')
+        with open(data_file, 'ab') as f:
+            f.truncate(len(shard_ids) * self.record_size)
+            f.write(crops.tobytes())
+        with open(os.path.join(self.folder, shard + '.ids'), 'a') as f:
+            f.write(''.join(i + '\n' for i in ids))
+        if self._index is not None:
+            for offset, object_id in enumerate(ids, len(shard_ids)):
+                self._index[object_id] = (shard, offset)
+        shard_ids.extend(ids)
+
+    def read_shard(self, shard):
+        """
+        returns a read-only memmap with all crops of a shard
+        """
+        n = len(self.shard_ids(shard))
+        if n == 0:
+            return np.empty((0,) + self.shape, dtype=self.dtype)
+        return np.memmap(
+            os.path.join(self.folder, shard + '.dat'), dtype=self.dtype,
+            mode='r', shape=(n,) + self.shape)
+
+    def live_offsets(self, shard):
+        """
+        returns the offsets of the records of a shard that the index points to,
+        leaving out records of ids that were appended again
+        """
+        index = self.index()
+        return np.array([
+            offset for offset, object_id in enumerate(self.shard_ids(shard))
+            if index[object_id] == (shard, offset)], dtype=np.int64)
+
+    def read_live_shard(self, shard, offsets=None):
+        """
+        returns (ids, crops) of the live records of a shard, see live_offsets;
+        crops is a memmap when the shard holds no stale records
+        """
+        ids, crops = self.shard_ids(shard), self.read_shard(shard)
+        if offsets is None:
+            offsets = self.live_offsets(shard)
+        if len(offsets) < len(ids):
+            ids, crops = [ids[o] for o in offsets], crops[offsets]
+        return ids, crops
+
+    def iter_shards(self):
+        """
+        yields (shard, ids, crops) of the live records of every shard
+        """
+        for shard in self.shards():
+            ids, crops = self.read_live_shard(shard)
+            yield shard, ids, crops
+
+    def read(self, ids, normalize=False):
+        """
+        returns a (len(ids),) + shape array with the crops of the given ids,
+        reading each shard once; if normalize, the stored bounds are applied
+        """
+        if normalize and self.bounds is None:
+            raise ValueError('no normalization bounds are stored; call set_normalization first')
+        index = self.index()
+        locations = [index[i] for i in ids]
+        X = np.empty((len(ids),) + self.shape, dtype=self.dtype)
+        by_shard = {}
+        for i, (shard, offset) in enumerate(locations):
+            by_shard.setdefault(shard, []).append((offset, i))
+        for shard, pairs in by_shard.items():
+            offsets, positions = np.array(pairs).T
+            X[positions] = self.read_shard(shard)[offsets]
+        if normalize:
+            X = normalize_batch(X, *self.bounds)
+        return X
+
+
+class SpectrumStore(CropArchive):
+    """
+    CropArchive of fixed-length float32 spectra with a validity mask
+    <shard>.valid holds one byte per record, 0 for spectra kept only as
+    placeholders (e.g. zero-padded or too sparse to be resampled), so that
+    records can stay aligned with the rows of their source matrices.
+    like records, validity bytes are written before the ids of their records.
+    """
+
+    def __init__(self, folder, length=None):
+        super().__init__(folder, None if length is None else (length,), np.float32)
+
+    def append(self, shard, ids, spectra, valid=None):
+        """
+        appends spectra of the given object ids to a shard
+        receives:
+            * valid     (ndarray) optional (len(ids),) boolean mask of valid spectra
+        """
+        if valid is None:
+            valid = np.ones(len(ids), dtype=bool)
+        if len(valid) != len(ids):
+            raise ValueError('expected {} validity flags, but {} were given'.format(len(ids), len(valid)))
+        with open(os.path.join(self.folder, shard + '.valid'), 'ab') as f:
+            f.truncate(len(self.shard_ids(shard)))
+            f.write(np.asarray(valid, dtype=np.uint8).tobytes())
+        super().append(shard, ids, spectra)
+
+    def read_valid(self, shard):
+        """
+        returns the boolean validity mask of the records of a shard
+        """
+        n = len(self.shard_ids(shard))
+        valid = np.fromfile(os.path.join(self.folder, shard + '.valid'), dtype=np.uint8, count=n)
+        return valid.astype(bool)
+
+    def iter_shards(self, valid_only=True):
+        """
+        yields (shard, ids, spectra) of the live records of every shard in
+        the store; invalid records are left out unless valid_only is False
+        """
+        for shard in self.shards():
+            offsets = self.live_offsets(shard)
+            ids, spectra = self.read_live_shard(shard, offsets)
+            if valid_only:
+                valid = self.read_valid(shard)[offsets]
+                if not valid.all():
+                    ids, spectra = [i for i, v in zip(ids, valid) if v], spectra[valid]
+            yield shard, ids, spectra
+
+    def is_valid(self, ids):
+        """
+        returns a boolean mask of the given ids whose spectra are valid
+        """
+        index = self.index()
+        valid = {shard: self.read_valid(shard) for shard in self.shards()}
+        return np.array([valid[index[i][0]][index[i][1]] for i in ids], dtype=bool)
+
+
+def get_checksum(crop):
+    return '{:08x}'.format(zlib.crc32(np.ascontiguousarray(crop).tobytes()))
+
+
+class CropManifest:
+    """
+    persisted record of the crops written to a crops folder
+    manifest.csv holds one line per crop: id, field, params, checksum, timestamp
+    every batch is appended with a single write and synced to disk, so a crash
+    loses at most the batch being written, and torn lines are ignored on load.
+    params describe how crops were made (e.g. size=32;asinh=0), and only crops
+    made with the manifest's params count as done.
+    sweeps commit all crops of a field at once and log it in fields.csv.
+    sweeps record 12-band crops found in a folder without a manifest with
+    legacy_params, since their band layout is unknown, so they are cropped again.
+    """
+    columns = ['id', 'field', 'params', 'checksum', 'timestamp']
+    legacy_params = 'legacy'
+
+    def __init__(self, folder, params=''):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.file = os.path.join(folder, 'manifest.csv')
+        self.params = params
+        self.entries = {}
+        if os.path.exists(self.file):
+            line = '\n'
+            with open(self.file) as f:
+                next(f, None)
+                for line in f:
+                    values = line.rstrip('\n').split(',')
+                    if len(values) == len(self.columns) and line.endswith('\n'):
+                        self.entries[values[0]] = values[1:]
+            if not line.endswith('\n'):
+                # terminate a torn line so that it does not swallow the next one
+                with open(self.file, 'a') as f:
+                    f.write('\n')
+        else:
+            with open(self.file, 'w') as f:
+                f.write(','.join(self.columns) + '\n')
+
+    def __contains__(self, object_id):
+        entry = self.entries.get(object_id)
+        return entry is not None and entry[1] == self.params
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, ids, checksums=None, params=None):
+        """
+        records crops of the given object ids
+        receives:
+            * ids           (list) object ids, whose field is the id prefix
+            * checksums     (list) checksums of crops, see get_checksum
+            * params        (str) params the crops were made with, if not the
+                            manifest's, e.g., legacy_params
+        """
+        if checksums is None:
+            checksums = [''] * len(ids)
+        if params is None:
+            params = self.params
+        timestamp = str(int(time()))
+        lines = []
+        for object_id, checksum in zip(ids, checksums):
+            entry = [object_id.split('.')[0], params, checksum, timestamp]
+            self.entries[object_id] = entry
+            lines.append(','.join([object_id] + entry) + '\n')
+        with open(self.file, 'a') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def log_field(self, field, n_objects):
+        """
+        appends a completed field to fields.csv, next to the manifest
+        """
+        fields_file = os.path.join(os.path.dirname(self.file), 'fields.csv')
+        new_file = not os.path.exists(fields_file)
+        with open(fields_file, 'a') as f:
+            if new_file:
+                f.write('field,params,n_objects,timestamp\n')
+            f.write('{},{},{},{}\n'.format(field, self.params, n_objects, int(time())))
+
+    def select_new(self, ids):
+        """
+        returns a boolean mask of ids that have not been cropped yet
+        """
+        return np.array([i not in self for i in ids], dtype=bool)
@@ -1,13 +1,19 @@
-from astropy import units as u
-from astropy.coordinates import SkyCoord
-from astropy.io import ascii
 from astroquery.sdss import SDSS
 from glob import glob
+from joblib import Parallel, delayed
+import json
 import numpy as np
 import os
 import pandas as pd
-from sklearn.model_selection import StratifiedShuffleSplit
+import threading
 import time
+import zlib
+
+from label_the_sky.preprocessing.crossmatch import SkyIndex, deduplicate_matches, get_sky_index
+from label_the_sky.preprocessing.imputation import impute_magnitudes
+from label_the_sky.preprocessing.splits import \
+    apply_saved_splits, assign_splits, get_labeled_strata, get_split_column, get_unlabeled_strata
+from label_the_sky.utils import is_parquet, read_table, write_table
 
 
 orig_cols = [
@@ -54,9 +60,180 @@ matched_cat_cols = [
 ]
 
 
-def gen_master_catalog(catalogs_path, output_file, header_file='csv/fits_header_cols.txt'):
+# dtypes of usecols when parsed; other columns are float32
+catalog_dtypes = {'ID': str, 'RA': np.float64, 'Dec': np.float64, 'X': np.float64, 'Y': np.float64}
+catalog_int_cols = {'X': np.int32, 'Y': np.int32, 'PhotoFlag': np.int16, 'nDet_auto': np.int8}
+
+
+def read_field_catalog(file, cols):
+    '''
+    reads the catalog of one field with typed columns, dropping incomplete rows
+    '''
+    dtypes = {c: catalog_dtypes.get(c, np.float32) for c in usecols}
+    cat = pd.read_csv(file,
+        delimiter=' ', skipinitialspace=True, comment='#', index_col=False,
+        header=None, names=cols, usecols=usecols, dtype=dtypes)
+
+    cat.dropna(inplace=True)
+    for col, dtype in catalog_int_cols.items():
+        cat[col] = np.round(cat[col].values).astype(dtype)
+    cat['ID'] = cat['ID'].str.replace('.griz', '', regex=False)
+    return cat
+
+
+def write_field_catalog(file, cols, output_folder=None):
+    '''
+    reads the catalog of one field and, if output_folder is given, writes it
+    as the field=<field> partition of a parquet dataset
+    returns:
+        a tuple (summary, cat), wherein cat is None when written to parquet
+    '''
+    field = file.split('/')[-1].split('.')[0]
+    cat = read_field_catalog(file, cols)
+    summary = {
+        'field': field, 'file': file, 'n_rows': len(cat),
+        'ra_min': cat.RA.min(), 'ra_max': cat.RA.max(),
+        'dec_min': cat.Dec.min(), 'dec_max': cat.Dec.max()}
+    if output_folder is None:
+        return summary, cat
+    partition = os.path.join(output_folder, 'field={}'.format(field))
+    if not os.path.exists(partition):
+        os.makedirs(partition)
+    tmp_file = os.path.join(partition, '.part-0.parquet')
+    cat.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, os.path.join(partition, 'part-0.parquet'))
+    return summary, None
+
+
+mag_cols = ['u', 'f378', 'f395', 'f410', 'f430', 'g', 'f515', 'r', 'f660', 'i', 'f861', 'z']
+err_cols = [m + '_err' for m in mag_cols]
+mock_cols = [m + '_mock' for m in mag_cols]
+
+
+def get_catalog_filters(
+        labeled=None, ndet=None, photoflag=None, zwarning=None,
+        mag_min=None, mag_max=None, e=None, mock=False):
+    '''
+    returns a declarative list of (column, op, value) filters, wherein op is
+    one of ==, !=, <, <=, >, >=, isna, notna; rows must satisfy all of them
+    receives:
+        * labeled       (bool) whether to keep only objects with (True) or
+                        without (False) a class
+        * ndet, photoflag, zwarning     (int) required values of these columns
+        * mag_min, mag_max  (float) magnitude window applied to all bands
+        * e             (float) maximum magnitude error in all bands
+        * mock          (bool) whether to apply the window to mock magnitudes too
+    '''
+    filters = []
+    if labeled is not None:
+        filters.append(('class', 'notna' if labeled else 'isna', None))
+    if ndet is not None:
+        filters.append(('ndet', '==', ndet))
+    if photoflag is not None:
+        filters.append(('photoflag', '==', photoflag))
+    if zwarning is not None:
+        filters.append(('zWarning', '==', zwarning))
+    if e is not None:
+        filters += [(c, '<=', e) for c in err_cols]
+    for c in mag_cols + (mock_cols if mock else []):
+        if mag_min is not None:
+            filters.append((c, '>=', mag_min))
+        if mag_max is not None:
+            filters.append((c, '<=', mag_max))
+    return filters
+
+
+comparisons = {
+    '==': np.equal, '!=': np.not_equal, '<': np.less, '<=': np.less_equal,
+    '>': np.greater, '>=': np.greater_equal}
+
+
+def get_filter_mask(df, filters):
+    '''
+    evaluates filters (see get_catalog_filters) over df as a single boolean mask
+    '''
+    mask = np.ones(len(df), dtype=bool)
+    for col, op, value in filters:
+        if op == 'isna':
+            mask &= df[col].isna().values
+        elif op == 'notna':
+            mask &= df[col].notna().values
+        else:
+            mask &= comparisons[op](df[col].values, value)
+    return mask
+
+
+def get_filter_expression(filters):
+    '''
+    translates filters (see get_catalog_filters) to a pyarrow expression, so
+    that parquet readers skip row groups and rows that do not satisfy them
+    '''
+    import pyarrow.compute as pc
+    expression = None
+    for col, op, value in filters:
+        field = pc.field(col)
+        if op == 'isna':
+            term = field.is_null(nan_is_null=True)
+        elif op == 'notna':
+            term = ~field.is_null(nan_is_null=True)
+        else:
+            term = getattr(field, '__{}__'.format({
+                '==': 'eq', '!=': 'ne', '<': 'lt', '<=': 'le', '>': 'gt', '>=': 'ge'}[op]))(value)
+        expression = term if expression is None else expression & term
+    return expression
+
+
+def get_catalog_columns(path):
+    '''
+    returns the column names of a catalog without reading its rows
+    '''
+    if is_parquet(path):
+        import pyarrow.dataset as ds
+        return ds.dataset(path, partitioning='hive').schema.names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def read_catalog(path, filters=None, columns=None, chunksize=1000000, **kwargs):
+    '''
+    reads the rows of a catalog that satisfy filters
+    parquet catalogs are filtered while decoded; csv catalogs are read in
+    chunks of chunksize rows that are filtered before being concatenated, so
+    that memory peaks at the size of the result plus one chunk
+    receives:
+        * path          (str or DataFrame) parquet dataset or file, or csv file
+        * filters       (list) see get_catalog_filters
+        * columns       (list) columns to be returned; default is all
+        * kwargs        extra arguments of pd.read_csv
+    '''
+    filters = filters or []
+    if isinstance(path, pd.DataFrame):
+        df = path[get_filter_mask(path, filters)] if filters else path
+        return df if columns is None else df[columns]
+    if is_parquet(path):
+        expression = get_filter_expression(filters) if filters else None
+        return pd.read_parquet(path, columns=columns, filters=expression)
+
+    usecols = None
+    if columns is not None:
+        usecols = list(columns) + [c for c, _, _ in filters if c not in columns]
+    chunks = []
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunksize, **kwargs):
+        chunks.append(chunk[get_filter_mask(chunk, filters)])
+    df = pd.concat(chunks, ignore_index=True)
+    return df if columns is None else df[columns]
+
+
+def gen_master_catalog(
+        catalogs_path, output_file, header_file='csv/fits_header_cols.txt', n_jobs=8):
     '''
     generates a master catalog from a folder of multiple catalogs (one per field)
+    field catalogs are parsed in parallel. if output_file ends with .parquet,
+    the master catalog is a parquet dataset partitioned by field (one
+    field=<field> folder each) that is read with read_table or
+    pd.read_parquet(output_file, columns=..., filters=...); otherwise, a csv
+    file. either way, a summary with the number of rows and the ra/dec range
+    of each field is saved to _summary.csv in the dataset folder, or next to
+    the csv file.
     '''
     files = glob(catalogs_path)
     files.sort()
@@ -64,25 +241,28 @@ def gen_master_catalog(catalogs_path, output_file, header_file='csv/fits_header_
 
     # get original cols from txt file
     with open(header_file, 'r') as f:
-        cols = f.read().split(',')
+        cols = f.read().strip().split(',')
 
-    with open(output_file, 'w') as f:
-        f.write(usecols_str)
+    if is_parquet(output_file):
+        output_folder = output_file
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+        summary_file = os.path.join(output_folder, '_summary.csv')
+    else:
+        output_folder = None
+        summary_file = os.path.splitext(output_file)[0] + '_summary.csv'
 
-    for ix, file in enumerate(files):
-        print('{}/{} processing {}...'.format(ix+1, n_files, file))
-        # stripe = filename.split('/')[-1].split('.')[0]
+    results = Parallel(n_jobs=n_jobs, return_as='generator')(
+        delayed(write_field_catalog)(file, cols, output_folder) for file in files)
 
-        cat = pd.read_csv(file,
-            delimiter=' ', skipinitialspace=True, comment='#', index_col=False,
-            header=None, names=orig_cols, usecols=usecols)
+    summaries = []
+    for ix, (summary, cat) in enumerate(results):
+        print('{}/{} processed {} ({} rows)'.format(ix+1, n_files, summary['file'], summary['n_rows']))
+        if cat is not None:
+            cat.to_csv(output_file, index=False, header=ix == 0, mode='w' if ix == 0 else 'a')
+        summaries.append(summary)
 
-        cat.dropna(inplace=True)
-        int_cols = ['X', 'Y']
-        cat[int_cols] = cat[int_cols].apply(lambda x: round(x)).astype(int)
-        cat['ID'] = cat['ID'].apply(lambda s: s.replace('.griz', ''))
-
-        cat.to_csv(output_file, index=False, header=False, mode='a')
+    pd.DataFrame(summaries).to_csv(summary_file, index=False)
 
 
 def filter_master_catalog(master_cat_file, output_file, usecols_orig, usecols_renamed):
@@ -90,11 +270,15 @@ def filter_master_catalog(master_cat_file, output_file, usecols_orig, usecols_re
     generates a catalog from master_catalog_dr_march2019.cat
     filtered by given columns
     '''
-    cat = pd.read_csv(
-        master_cat_file, delimiter=' ', skipinitialspace=True, comment='#',
-        index_col=False, usecols=usecols)
+    # incomplete rows are dropped while reading
+    filters = [(c, 'notna', None) for c in usecols]
+    if is_parquet(master_cat_file):
+        cat = read_catalog(master_cat_file, filters, columns=usecols)
+    else:
+        cat = read_catalog(
+            master_cat_file, filters, columns=usecols,
+            delimiter=' ', skipinitialspace=True, comment='#', index_col=False)
 
-    cat.dropna(inplace=True)
     int_cols = ['X', 'Y']
     cat[int_cols] = cat[int_cols].apply(lambda x: round(x)).astype(int)
     cat = cat[usecols_orig]
@@ -107,70 +291,182 @@ def filter_master_catalog(master_cat_file, output_file, usecols_orig, usecols_re
 
 # m = 22.5 - 2.5*log10(FLUX)
 
-def query_sdss(query_str, filename, obj_key='objID', data_release=14):
-    objid = -1
-    cnt = 0
-    row_count = 500000
+def get_sdss_harvest(query_str, data_release):
+    '''
+    returns the key of a harvest, e.g., dr16_1a2b3c4d, which identifies its
+    cursor and pages; whitespace in query_str does not change it
+    '''
+    return 'dr{}_{:08x}'.format(data_release, zlib.crc32(' '.join(query_str.split()).encode()))
 
-    print('querying', filename)
-    while row_count == 500000:
-        start = time.time()
-        print('query number', cnt)
-        table = SDSS.query_sql(query_str.format(objid), timeout=600, data_release=data_release)
-        print('seconds taken:', int(time.time()-start))
 
-        row_count = len(table)
-        objid = table[row_count-1][obj_key]
-        print('row_count', row_count)
-        print('head')
-        print(table[:5])
-        print('tail')
-        print(table[-5:])
+def get_sdss_cursor_file(filename):
+    root, _ = os.path.splitext(filename.format('cursor'))
+    return root + '.json'
 
-        ascii.write(table, filename.format(cnt), format='csv', fast_writer=False)
-        print('saved to csv')
-        cnt+=1
 
+def load_sdss_cursor(filename):
+    cursor_file = get_sdss_cursor_file(filename)
+    if not os.path.exists(cursor_file):
+        return {}
+    with open(cursor_file) as f:
+        return json.load(f)
 
-def match_catalogs(new_df, base_df, final_cols, matched_cat_path=None, max_distance=1.0):
-    print('matching')
-    base_ra = base_df['ra'].values
-    base_dec = base_df['dec'].values
 
-    new_ra = new_df['ra'].values
-    new_dec = new_df['dec'].values
+def save_sdss_cursor(filename, cursor):
+    cursor_file = get_sdss_cursor_file(filename)
+    tmp_file = cursor_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(cursor, f, indent=1)
+    os.replace(tmp_file, cursor_file)
 
-    my_coord = SkyCoord(ra=new_ra*u.degree, dec=new_dec*u.degree)
-    catalog_coord = SkyCoord(ra=base_ra*u.degree, dec=base_dec*u.degree)
 
-    # a k-d tree is built from catalog_coord (SPLUS)
-    # my_coord (SLOAN) is queried on the k-d tree
-    idx, d2d, d3d = my_coord.match_to_catalog_sky(catalog_coord)
+def query_sdss_range(
+        query_str, filename, obj_key, query_fn, cursor, lock, harvest, range_key,
+        id_max, page_size=500000):
+    '''
+    pages through the objects of one id range, resuming from its cursor
+    '''
+    with lock:
+        state = cursor.setdefault(harvest, {}).setdefault(
+            range_key, {'last_id': int(range_key.split(':')[0]), 'pages': 0})
+        last_id, cnt = state['last_id'], state['pages']
+    n_rows = 0
+    row_count = page_size
+    while row_count == page_size:
+        start = time.time()
+        print(range_key, 'query number', cnt)
+        table = query_fn(query_str.format(last_id, id_max))
+        row_count = 0 if table is None else len(table)
+        print(range_key, 'seconds taken:', int(time.time()-start), 'row_count', row_count)
+        if row_count == 0:
+            break
+        if not isinstance(table, pd.DataFrame):
+            table = table.to_pandas()
+
+        page_file = filename.format('{}_{}'.format(harvest, cnt) if range_key == default_sdss_range else
+                                    '{}_{}_{}'.format(harvest, range_key.replace(':', '-'), cnt))
+        root, ext = os.path.splitext(page_file)
+        tmp_file = root + '.tmp' + ext
+        write_table(table, tmp_file)
+        os.replace(tmp_file, page_file)
+
+        last_id = int(table[obj_key].values[-1])
+        cnt += 1
+        n_rows += row_count
+        with lock:
+            state['last_id'], state['pages'] = last_id, cnt
+            save_sdss_cursor(filename, cursor)
+    return n_rows
+
+
+default_sdss_range = '-1:{}'.format(np.iinfo(np.int64).max)
+
+
+def query_sdss(
+        query_str, filename, obj_key='objID', data_release=14, id_ranges=None,
+        n_jobs=1, page_size=500000, query_fn=None):
+    '''
+    queries sdss in pages of page_size objects ordered by obj_key, saving each
+    page to filename.format('<harvest>_<page>'), see get_sdss_harvest
+    the last id of every saved page is recorded in a cursor file
+    (filename.format('cursor') with a .json extension) under the harvest of
+    data_release and query_str, so an interrupted or repeated harvest resumes
+    after the last saved page and, once complete, only fetches rows with ids
+    beyond it. this delta only holds when obj_key grows with new rows, e.g.,
+    specObjID; new spectra of known objects have old bestObjIDs and would be
+    missed. another release or query starts its own harvest from scratch, so
+    rows revised in a release (e.g., z or zWarning) are fetched again
+    receives:
+        * query_str     (str) sql query ordered by obj_key, wherein {0} is the
+                        last id already fetched and an optional {1} is the
+                        upper bound of the id range, e.g.,
+                        "... where specObjID>{0} and specObjID<={1} order by specObjID"
+        * filename      (str) page file pattern; .parquet pages are saved as
+                        parquet, other extensions as csv
+        * id_ranges     (list) disjoint (id_min, id_max] ranges harvested
+                        concurrently; their pages are named
+                        filename.format('<harvest>_<id_min>-<id_max>_<page>').
+                        query_str must use {1} when given
+        * n_jobs        (int) number of ranges queried at once
+        * query_fn      (callable) function that receives a query and returns
+                        an astropy Table or DataFrame; default is SDSS.query_sql
+    returns:
+        the number of rows fetched
+    '''
+    if query_fn is None:
+        def query_fn(query):
+            return SDSS.query_sql(query, timeout=600, data_release=data_release)
+    if id_ranges is None:
+        range_keys = [default_sdss_range]
+    else:
+        range_keys = ['{}:{}'.format(id_min, id_max) for id_min, id_max in id_ranges]
+
+    folder = os.path.dirname(filename)
+    if folder != '' and not os.path.exists(folder):
+        os.makedirs(folder)
+    harvest = get_sdss_harvest(query_str, data_release)
+    cursor = load_sdss_cursor(filename)
+    lock = threading.Lock()
+
+    print('querying', filename, 'harvest', harvest)
+    n_rows = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(query_sdss_range)(
+        query_str, filename, obj_key, query_fn, cursor, lock, harvest, key,
+        int(key.split(':')[1]), page_size) for key in range_keys)
+    print('rows fetched', sum(n_rows))
+    return sum(n_rows)
+
+
+def load_sdss_pages(filename, columns=None, harvest=None):
+    '''
+    returns the pages saved by query_sdss as a single DataFrame
+    receives:
+        * harvest       (str) only pages of this harvest, see get_sdss_harvest;
+                        default is all pages
+    '''
+    pattern = '*' if harvest is None else harvest + '_*'
+    files = sorted(
+        f for f in glob(filename.format(pattern))
+        if '.tmp' not in f and f != get_sdss_cursor_file(filename))
+    return pd.concat([read_table(f, columns=columns) for f in files], ignore_index=True)
 
-    print('len unique idx', len(np.unique(idx)))
-    print('len idx', len(idx))
 
-    sep_constraint = d2d < max_distance * u.arcsec
-    my_matches = my_coord[sep_constraint] 
-    catalog_matches = catalog_coord[idx[sep_constraint]] 
+def match_catalogs(
+        new_df, base_df, final_cols, matched_cat_path=None, max_distance=1.0,
+        index=None, unique=False):
+    '''
+    matches each object of new_df to its nearest object of base_df within
+    max_distance arcsec, returning the base rows joined with their matches;
+    columns of new_df that are also in base_df are suffixed with _
+    receives:
+        * index         (SkyIndex) optional prebuilt index of base_df, see
+                        crossmatch.get_sky_index
+        * unique        (bool) whether to keep only the closest match of
+                        each base object
+    '''
+    print('matching')
+    if index is None:
+        # a k-d tree is built from base_df (SPLUS)
+        index = SkyIndex(base_df['ra'].values, base_df['dec'].values)
+    # new_df (SLOAN) is queried on the k-d tree
+    idx, d2d = index.query_nearest(new_df['ra'].values, new_df['dec'].values, max_distance)
+    matched = idx >= 0
 
-    print('my coord matches', my_matches.shape)
-    print('catalog matches', catalog_matches.shape)
+    print('len unique idx', len(np.unique(idx[matched])))
+    print('matches', matched.sum())
 
     new_df['base_idx'] = idx
-    new_df['d2d'] = d2d
-    new_df['matched'] = sep_constraint
+    new_df['d2d'] = d2d / 3600  # degrees
+    new_df['matched'] = matched
     new_df = new_df[new_df.matched]
-    print(new_df.base_idx.value_counts())
-    # agg = new_df.groupby('base_idx')
-    # agg = agg.apply(lambda s: s.sort_values('d2d', ascending=True).head(1))
-    # agg.drop(columns=['base_idx'], inplace=True)
-    # print(agg.d2d.min(), agg.d2d.max())
+    if unique:
+        new_df = new_df[deduplicate_matches(new_df.base_idx.values, new_df.d2d.values)]
 
-    final_cat = base_df.merge(new_df, how='left', left_index=True, right_on='base_idx', suffixes=('', '_'))
-    final_cat = final_cat[~final_cat.matched.isna()]
-
-    print(final_cat.columns)
+    # rows in base_df order, then in new_df order
+    new_df = new_df.iloc[np.argsort(new_df.base_idx.values, kind='stable')]
+    base_part = base_df.iloc[new_df.base_idx.values].reset_index(drop=True)
+    new_part = new_df.reset_index(drop=True)
+    new_part.columns = [c + '_' if c in base_df.columns else c for c in new_part.columns]
+    final_cat = pd.concat([base_part, new_part], axis=1)
 
     final_cat['redshift'] = final_cat.z_
 
@@ -202,52 +498,33 @@ def pixels_to_int(filepath):
     df.to_csv(filepath, index=False)
 
 
-def fill_undetected(df):
-    mags = ['u','f378','f395','f410','f430','g','f515','r','f660','i','f861','z']
-    df_mags = df[mags]
-    df_mags[df_mags.values==99] = np.nan
-    df_mags[df_mags.values==-99] = np.nan
-    df_mags = df_mags.apply(lambda row: row.fillna(row.median()), axis=1) # fill with median per row
-    df[mags] = df_mags.values
+def fill_undetected(df, method='median'):
+    '''
+    fills undetected (NaN or +-99) magnitudes of df in place, by default with
+    the median per row; see imputation.imputers for other methods
+    '''
+    df[mag_cols] = impute_magnitudes(df[mag_cols].values, method)
 
 
 def stratified_split(
-    df, mag_min=0, mag_max=35, fill_undet=False, e=None, verbose=False):
-    if type(df) is str:
-        df = pd.read_csv(df)
-    df = df[(~df['class'].isna()) & (df.ndet==12) & (df.photoflag==0) & (df.zWarning==0)]
-    if e is not None:
-        df = df[(
-            df.u_err <= e) & (df.f378_err <= e) & (df.f395_err <= e) & (df.f410_err <= e) & (df.f430_err <= e) & (df.g_err <= e) & (
-            df.f515_err <= e) & (df.r_err <= e) & (df.f660_err <= e) & (df.i_err <= e) & (df.f861_err <= e) & (df.z_err <= e)]
-
-    # filter undetected
-    df = df[df.u.between(mag_min, mag_max)]
-    df = df[df.g.between(mag_min, mag_max)]
-    df = df[df.r.between(mag_min, mag_max)]
-    df = df[df.i.between(mag_min, mag_max)]
-    df = df[df.z.between(mag_min, mag_max)]
-    df = df[df.f378.between(mag_min, mag_max)]
-    df = df[df.f395.between(mag_min, mag_max)]
-    df = df[df.f410.between(mag_min, mag_max)]
-    df = df[df.f430.between(mag_min, mag_max)]
-    df = df[df.f515.between(mag_min, mag_max)]
-    df = df[df.f660.between(mag_min, mag_max)]
-    df = df[df.f861.between(mag_min, mag_max)]
-
-    if 'u_mock' in df.columns:
-        df = df[df.u_mock.between(mag_min, mag_max)]
-        df = df[df.g_mock.between(mag_min, mag_max)]
-        df = df[df.r_mock.between(mag_min, mag_max)]
-        df = df[df.i_mock.between(mag_min, mag_max)]
-        df = df[df.z_mock.between(mag_min, mag_max)]
-        df = df[df.f378_mock.between(mag_min, mag_max)]
-        df = df[df.f395_mock.between(mag_min, mag_max)]
-        df = df[df.f410_mock.between(mag_min, mag_max)]
-        df = df[df.f430_mock.between(mag_min, mag_max)]
-        df = df[df.f515_mock.between(mag_min, mag_max)]
-        df = df[df.f660_mock.between(mag_min, mag_max)]
-        df = df[df.f861_mock.between(mag_min, mag_max)]
+    df, mag_min=0, mag_max=35, fill_undet=False, e=None, verbose=False,
+    test_size=0.05, val_size=0.05, exact=True, split_file=None):
+    '''
+    filters labeled objects and assigns them to train, val and test splits,
+    stratified by class and r magnitude; see splits.assign_splits
+    receives:
+        * exact         (bool) whether proportions are exact per stratum;
+                        if False, splits depend only on object ids and strata
+                        are represented only in expectation
+        * split_file    (str) optional csv or parquet (id, split) table that
+                        keeps the split of objects across catalog updates
+    '''
+    columns = get_catalog_columns(df) if type(df) is str else df.columns
+    # magnitudes out of [mag_min, mag_max] are undetected
+    filters = get_catalog_filters(
+        labeled=True, ndet=12, photoflag=0, zwarning=0, mag_min=mag_min,
+        mag_max=mag_max, e=e, mock='u_mock' in columns)
+    df = read_catalog(df, filters)
 
     print('shape after filtering', df.shape)
 
@@ -255,90 +532,45 @@ def stratified_split(
         print('filling undetected')
         fill_undetected(df)
 
-    df.loc[df.r<14,'r'] = 14
-    df.loc[df.r>21,'r'] = 21
-    df['class_mag'] = np.round(df.r.values).astype(np.uint8)
-    df.loc[df['class']=='QSO', 'class_mag'] = df.class_mag.apply(lambda r: r if r%2==0 else r+1)
-    df['class_mag'] = df['class'] + df['class_mag'].astype(str)
-
-    # hard code small subsets
-    df.loc[(df.class_mag=='QSO14')|(df.class_mag=='QSO16'), 'class_mag'] = 'QSO18'
-    df.loc[df.class_mag=='GALAXY14', 'class_mag'] = 'GALAXY16'
-    df.loc[df.class_mag=='STAR14', 'class_mag'] = 'STAR16'
-    df.loc[df.class_mag=='GALAXY24', 'class_mag'] = 'GALAXY23'
-    df.loc[df.class_mag=='GALAXY20', 'class_mag'] = 'GALAXY19'
-    df.loc[df.class_mag=='STAR23', 'class_mag'] = 'STAR22'
-
-    df['class_mag'] = df['class_mag'].astype('category')
-    df['class_mag_int'] = df.class_mag.cat.codes
-    df['split'] = ''
-
-    # split classification set
-    X = df.index.values
-    y = df.class_mag_int.values
-    sss = StratifiedShuffleSplit(n_splits=1, test_size=0.05, random_state=0)
-    train_idx, test_idx = next(sss.split(X,y))
-    df_train_idx, df_test_idx = X[train_idx], X[test_idx]
-    df.loc[df_train_idx, 'split'] = 'train'
-    df.loc[df_test_idx, 'split'] = 'test'
-
-    X = df[(df.split=='train')].index.values
-    y = df[(df.split=='train')].class_mag_int.values
-    sss = StratifiedShuffleSplit(n_splits=1, test_size=0.05, random_state=0)
-    train_idx, test_idx = next(sss.split(X,y))
-    df_train_idx, df_test_idx = X[train_idx], X[test_idx]
-    df.loc[df_train_idx, 'split'] = 'train'
-    df.loc[df_test_idx, 'split'] = 'val'
+    df['r'] = df.r.clip(14, 21)
+    strata, labels = get_labeled_strata(df['class'].values, df.r.values)
+    splits = assign_splits(df.id.values, strata, test_size, val_size, exact)
+    if split_file is not None:
+        splits = apply_saved_splits(df.id.values, splits, split_file)
+    df['split'] = get_split_column(splits)
 
     if verbose:
         print('SPLITS PER CAT')
         print()
-        for i in np.unique(df.class_mag_int.values):
-            dff = df[df.class_mag_int==i]
-            print(dff['class_mag'].head(1))
-            print()
+        counts = pd.crosstab(
+            pd.Series(strata).map(labels).values, df.split.values,
+            rownames=['class_mag'], colnames=['split'])
+        print(counts)
+        print()
 
-    df.drop(columns=['class_mag', 'class_mag_int'], inplace=True)
     return df
 
 
-def stratified_split_unlabeled(df, e, test_split=0.05, val_split=0.05, n=None):
-    if type(df) == str:
-        df = pd.read_csv(df)
-    df = df[(df['class'].isna())]
-    print('shape before filtering', df.shape)
-    df = df[(df.ndet==12) & (df.photoflag==0)]
-    df = df[(
-        df.u_err <= e) & (df.f378_err <= e) & (df.f395_err <= e) & (df.f410_err <= e) & (df.f430_err <= e) & (df.g_err <= e) & (
-        df.f515_err <= e) & (df.r_err <= e) & (df.f660_err <= e) & (df.i_err <= e) & (df.f861_err <= e) & (df.z_err <= e)]
+def stratified_split_unlabeled(
+        df, e, test_split=0.05, val_split=0.05, n=None, exact=True, split_file=None):
+    '''
+    filters unlabeled objects and assigns them to train, val and test splits,
+    stratified by r magnitude; see stratified_split
+    '''
+    filters = get_catalog_filters(labeled=False, ndet=12, photoflag=0, e=e)
+    df = read_catalog(df, filters)
     print('shape after filtering', df.shape)
 
-    df['class_mag'] = df.r.apply(lambda r: r if r%2==0 else r+1).astype(np.uint8)
-
     if n is not None:
         # df = df.sort_values(by='r_err', ascending=False)
         # df = df.iloc[:n]
-        df = df.sample(n)
-
-    # train-test split
-    X = df.index.values
-    y = df.class_mag.values
-    sss = StratifiedShuffleSplit(n_splits=1, test_size=test_split, random_state=0)
-    train_idx, test_idx = next(sss.split(X,y))
-    df_train_idx, df_test_idx = X[train_idx], X[test_idx]
-    df.loc[df_train_idx, 'split'] = 'train'
-    df.loc[df_test_idx, 'split'] = 'test'
-
-    # train-val split
-    X = df[df.split=='train'].index.values
-    y = df[df.split=='train'].class_mag.values
-    sss = StratifiedShuffleSplit(n_splits=1, test_size=val_split, random_state=0)
-    train_idx, test_idx = next(sss.split(X,y))
-    df_train_idx, df_test_idx = X[train_idx], X[test_idx]
-    df.loc[df_train_idx, 'split'] = 'train'
-    df.loc[df_test_idx, 'split'] = 'val'
-
-    df.drop(columns=['class_mag'], inplace=True)
+        df = df.sample(n, random_state=0)
+
+    strata = get_unlabeled_strata(df.r.values)
+    splits = assign_splits(df.id.values, strata, test_split, val_split, exact)
+    if split_file is not None:
+        splits = apply_saved_splits(df.id.values, splits, split_file)
+    df['split'] = get_split_column(splits)
     return df
 
 
@@ -360,11 +592,11 @@ if __name__ == '__main__':
 
     spec_query = '''
     select
-    bestObjID, ra, dec, class, subclass, z, zErr, zWarning,
+    specObjID, bestObjID, ra, dec, class, subclass, z, zErr, zWarning,
     run2d, mjd, plate, fiberID
     from SpecObj
-    where abs(dec) < 1.46 and bestObjID>{}
-    order by bestObjID
+    where abs(dec) < 1.46 and specObjID>{}
+    order by specObjID
     '''
     # master catalog: dec in (-1.4139, 1.4503)
     # query_sdss(photo_query, 'csv/sdss_photo_DR16_bestobjids_{}.csv', obj_key='objID', data_release=16)
@@ -380,7 +612,9 @@ if __name__ == '__main__':
     splus_cat = pd.read_csv('csv/dr1.csv')
     sloan_cat = pd.read_csv('csv/sdss_spec_DR16.csv')
     matched_cat = 'csv/dr1_crossmatched.csv'
-    df = match_catalogs(sloan_cat, splus_cat, matched_cat_cols, matched_cat)
+    splus_index = get_sky_index(
+        splus_cat.ra.values, splus_cat.dec.values, 'csv/dr1_skyindex.pkl', 'csv/dr1.csv')
+    df = match_catalogs(sloan_cat, splus_cat, matched_cat_cols, matched_cat, index=splus_index)
 
     df = pd.read_csv(matched_cat)
     df = df[(df.photoflag==0)&(df.ndet==12)&(df.zWarning==0)&(df.bestObjID!=0)]
@@ -0,0 +1,284 @@
+from joblib import Parallel, delayed
+import numpy as np
+import os
+import pandas as pd
+import pickle
+from scipy.spatial import cKDTree
+import shutil
+from tempfile import mkdtemp
+
+from label_the_sky.utils import is_parquet
+
+
+def radec_to_xyz(ra, dec):
+    """
+    returns (n, 3) unit vectors of the given coordinates in degrees
+    """
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=1)
+
+
+def arcsec_to_chord(d):
+    return 2 * np.sin(np.radians(np.asarray(d, dtype=np.float64) / 3600) / 2)
+
+
+def chord_to_arcsec(c):
+    return np.degrees(2 * np.arcsin(np.minimum(np.asarray(c) / 2, 1))) * 3600
+
+
+class SkyIndex:
+    """
+    k-d tree over the unit vectors of a catalog's coordinates, built once and
+    reused across crossmatches; the chord distance between unit vectors is
+    monotonic in the angular separation, so nearest neighbours and radius
+    matches are exact
+    queries are made in chunks of chunk_size objects to bound memory, and
+    all distances are given in arcsec
+    """
+
+    def __init__(self, ra, dec, leafsize=16):
+        self.n = len(ra)
+        self.tree = cKDTree(radec_to_xyz(ra, dec), leafsize=leafsize)
+
+    def save(self, index_file):
+        tmp_file = index_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, index_file)
+
+    @staticmethod
+    def load(index_file):
+        with open(index_file, 'rb') as f:
+            return pickle.load(f)
+
+    def query_nearest(self, ra, dec, max_distance=None, chunk_size=1000000):
+        """
+        returns the nearest indexed object of each given coordinate
+        receives:
+            * ra, dec       (ndarray) coordinates in degrees
+            * max_distance  (float) optional maximum separation in arcsec
+        returns:
+            a tuple (idx, d2d) of positions in the index and separations in
+            arcsec; idx is -1 and d2d is inf where nothing is within max_distance
+        """
+        upper = np.inf if max_distance is None else arcsec_to_chord(max_distance)
+        idx = np.full(len(ra), -1, dtype=np.int64)
+        d2d = np.full(len(ra), np.inf)
+        for i in range(0, len(ra), chunk_size):
+            xyz = radec_to_xyz(ra[i:i + chunk_size], dec[i:i + chunk_size])
+            chord, nearest = self.tree.query(xyz, distance_upper_bound=upper)
+            found = nearest < self.n
+            idx[i:i + chunk_size][found] = nearest[found]
+            d2d[i:i + chunk_size][found] = chord_to_arcsec(chord[found])
+        return idx, d2d
+
+    def query_radius(self, ra, dec, radius, chunk_size=1000000):
+        """
+        returns all pairs of given coordinates and indexed objects that are
+        within radius
+        receives:
+            * ra, dec       (ndarray) coordinates in degrees
+            * radius        (float) maximum separation in arcsec
+        returns:
+            a tuple (query_idx, idx, d2d) of positions in ra/dec, positions in
+            the index and separations in arcsec, sorted by query_idx and d2d
+        """
+        ra, dec = np.asarray(ra), np.asarray(dec)
+        chord = arcsec_to_chord(radius)
+        query_idx, idx = [], []
+        for i in range(0, len(ra), chunk_size):
+            xyz = radec_to_xyz(ra[i:i + chunk_size], dec[i:i + chunk_size])
+            matches = self.tree.query_ball_point(xyz, chord)
+            counts = np.array([len(m) for m in matches], dtype=np.int64)
+            query_idx.append(np.repeat(np.arange(i, i + len(xyz)), counts))
+            idx.append(np.fromiter(
+                (j for m in matches for j in m), dtype=np.int64, count=counts.sum()))
+        query_idx = np.concatenate(query_idx) if query_idx else np.empty(0, dtype=np.int64)
+        idx = np.concatenate(idx) if idx else np.empty(0, dtype=np.int64)
+        xyz = radec_to_xyz(ra[query_idx], dec[query_idx])
+        d2d = chord_to_arcsec(np.linalg.norm(xyz - self.tree.data[idx], axis=1))
+        order = np.lexsort((d2d, query_idx))
+        return query_idx[order], idx[order], d2d[order]
+
+
+def get_sky_index(ra, dec, index_file=None, source_file=None):
+    """
+    returns the SkyIndex of a catalog, loaded from index_file when it exists
+    and is newer than source_file (e.g., the catalog file), or built and
+    saved to index_file otherwise
+    """
+    if index_file is not None and os.path.exists(index_file):
+        if source_file is None or os.path.getmtime(index_file) >= os.path.getmtime(source_file):
+            index = SkyIndex.load(index_file)
+            if index.n == len(ra):
+                return index
+    print('building sky index')
+    index = SkyIndex(ra, dec)
+    if index_file is not None:
+        index.save(index_file)
+    return index
+
+
+def deduplicate_matches(idx, d2d):
+    """
+    keeps only the closest match of each indexed object
+    returns:
+        boolean mask over the given matches
+    """
+    order = np.lexsort((d2d, idx))
+    keep = np.zeros(len(idx), dtype=bool)
+    _, first = np.unique(idx[order], return_index=True)
+    keep[order[first]] = True
+    return keep
+
+
+def iter_catalog_chunks(path, columns=None, chunksize=1000000):
+    """
+    yields DataFrames of at most chunksize rows of a csv or parquet catalog
+    """
+    if is_parquet(path):
+        import pyarrow.dataset as ds
+        dataset = ds.dataset(path, partitioning='hive')
+        for batch in dataset.to_batches(columns=columns, batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+            yield chunk
+
+
+def get_tiles(ra, dec, tile_size, margin=0):
+    """
+    returns the (n_tiles, 2) (object position, tile) pairs of the given
+    coordinates in tiles of tile_size x tile_size degrees of dec and ra,
+    including tiles within margin degrees of each object
+    """
+    n_ra = int(np.ceil(360 / tile_size))
+    ra = np.asarray(ra, dtype=np.float64) % 360
+    dec = np.asarray(dec, dtype=np.float64)
+    # margin along ra grows towards the poles; it is capped at one tile, which
+    # holds for all but arcsec margins within a few tiles of the poles
+    ra_margin = margin / np.maximum(np.cos(np.radians(np.minimum(np.abs(dec) + margin, 90))), 1e-12)
+    ra_margin = np.minimum(ra_margin, tile_size)
+    pairs = []
+    for d_dec in ([0] if margin == 0 else [-1, 0, 1]):
+        for d_ra in ([0] if margin == 0 else [-1, 0, 1]):
+            dec_bin = np.floor((dec + d_dec * margin + 90) / tile_size).astype(np.int64)
+            ra_bin = np.floor(((ra + d_ra * ra_margin) % 360) / tile_size).astype(np.int64) % n_ra
+            pairs.append(np.stack([np.arange(len(ra)), dec_bin * n_ra + ra_bin], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def partition_catalog(path, folder, tile_size, margin=0, columns=None, chunksize=1000000):
+    """
+    splits a catalog into one folder of parquet parts per sky tile, streaming
+    it in chunks; objects within margin degrees of a tile are copied into it
+    returns:
+        the set of tiles
+    """
+    tiles = set()
+    for ix, chunk in enumerate(iter_catalog_chunks(path, columns, chunksize)):
+        chunk = chunk.reset_index(drop=True)
+        pairs = get_tiles(chunk['ra'].values, chunk['dec'].values, tile_size, margin)
+        order = np.argsort(pairs[:, 1], kind='stable')
+        pairs = pairs[order]
+        keys, starts = np.unique(pairs[:, 1], return_index=True)
+        for key, rows in zip(keys, np.split(pairs[:, 0], starts[1:])):
+            tile_folder = os.path.join(folder, 'tile={}'.format(key))
+            if not os.path.exists(tile_folder):
+                os.makedirs(tile_folder)
+            chunk.iloc[rows].to_parquet(
+                os.path.join(tile_folder, 'part-{}.parquet'.format(ix)), index=False)
+            tiles.add(int(key))
+    return tiles
+
+
+def crossmatch_tile(new_folder, base_folder, tile, max_distance=1.0, unique=False, output_folder=None):
+    """
+    matches the objects of new_folder in tile to their nearest base objects,
+    whose tile includes a margin of max_distance
+    returns:
+        the matched rows, or their number when saved to output_folder
+    """
+    new_df = pd.read_parquet(os.path.join(new_folder, 'tile={}'.format(tile)))
+    base_tile = os.path.join(base_folder, 'tile={}'.format(tile))
+    if not os.path.exists(base_tile):
+        return 0 if output_folder is not None else None
+    base_df = pd.read_parquet(base_tile)
+
+    index = SkyIndex(base_df['ra'].values, base_df['dec'].values)
+    idx, d2d = index.query_nearest(new_df['ra'].values, new_df['dec'].values, max_distance)
+    matched = idx >= 0
+    idx, d2d, new_df = idx[matched], d2d[matched], new_df[matched]
+    if unique:
+        keep = deduplicate_matches(idx, d2d)
+        idx, d2d, new_df = idx[keep], d2d[keep], new_df[keep]
+
+    new_part = new_df.reset_index(drop=True)
+    new_part.columns = [c + '_' if c in base_df.columns else c for c in new_part.columns]
+    matches = pd.concat([base_df.iloc[idx].reset_index(drop=True), new_part], axis=1)
+    matches['d2d'] = d2d / 3600  # degrees, as in match_catalogs
+
+    if output_folder is None:
+        return matches
+    matches.to_parquet(os.path.join(output_folder, 'tile-{}.parquet'.format(tile)), index=False)
+    return len(matches)
+
+
+def crossmatch_tiled(
+        new_path, base_path, output_file, max_distance=1.0, tile_size=1.0,
+        n_jobs=8, unique=False, new_columns=None, base_columns=None,
+        chunksize=1000000, work_folder=None):
+    """
+    out-of-core version of catalog.match_catalogs for catalogs larger than
+    memory: both catalogs are streamed into tiles of tile_size degrees, base
+    tiles with a margin of max_distance so that matches across tile borders
+    are kept, and tile pairs are matched in n_jobs processes
+    the matched rows (base columns, then new columns, suffixed with _ when
+    also in base, then d2d in degrees) are streamed to output_file: a folder
+    of parquet parts when it ends with .parquet, a csv file otherwise.
+    unlike match_catalogs, rows are grouped by tile
+    receives:
+        * new_path, base_path   (str) csv or parquet catalogs with ra/dec columns
+        * max_distance          (float) maximum separation in arcsec
+        * tile_size             (float) tile side in degrees
+        * unique                (bool) whether to keep only the closest match
+                                of each base object; with margins, a base object
+                                near a border may still match once per tile
+        * work_folder           (str) folder for the tiles, removed at the end;
+                                default is next to output_file
+    returns:
+        the number of matched rows
+    """
+    work_folder = mkdtemp(dir=work_folder or os.path.dirname(os.path.abspath(output_file)))
+    new_folder = os.path.join(work_folder, 'new')
+    base_folder = os.path.join(work_folder, 'base')
+    try:
+        print('partitioning catalogs')
+        tiles = partition_catalog(new_path, new_folder, tile_size, 0, new_columns, chunksize)
+        partition_catalog(base_path, base_folder, tile_size, max_distance / 3600, base_columns, chunksize)
+
+        output_folder = None
+        if is_parquet(output_file):
+            output_folder = output_file
+            if not os.path.exists(output_folder):
+                os.makedirs(output_folder)
+
+        print('matching {} tiles'.format(len(tiles)))
+        results = Parallel(n_jobs=n_jobs, return_as='generator')(
+            delayed(crossmatch_tile)(new_folder, base_folder, tile, max_distance, unique, output_folder)
+            for tile in sorted(tiles))
+        n_matches = 0
+        header = True
+        for result in results:
+            if output_folder is not None:
+                n_matches += result
+            elif result is not None and len(result) > 0:
+                result.to_csv(output_file, index=False, header=header, mode='w' if header else 'a')
+                header = False
+                n_matches += len(result)
+    finally:
+        shutil.rmtree(work_folder)
+    print('matches', n_matches)
+    return n_matches
@@ -1,40 +1,97 @@
 from astropy.io import fits
-from astropy.table import Table
-from astropy.visualization import AsinhStretch
 from cv2 import imread, imwrite, resize, INTER_CUBIC
 from glob import glob
 from joblib import Parallel, delayed
+import json
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 import os
+from tempfile import gettempdir, mkstemp
 from time import time
 
+from label_the_sky.preprocessing.archive import CropArchive, CropManifest, get_checksum
+from label_the_sky.preprocessing.stats import RunningStats, normalize_batch
+from label_the_sky.preprocessing.transforms import \
+    apply_transforms, compile_transforms, describe_transforms, get_calibration_scale, get_step
+from label_the_sky.utils import read_table, write_table
 
-asinh_transform = AsinhStretch()
 
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+CV_MAX_CHANNELS = 128  # max channels in a cv2 resize call (512 before cv2 5.0)
+MAX_HALF_WIDTH = 75  # max half-width of crop windows, 3 * (largest fwhm with photoflag==0) / 2
 
-def get_metadata(folder_pattern, save_file):
+zp_tables = {}  # zp folder -> zero point table, see get_zp_table
+
+
+def read_header_metadata(file):
+    """
+    reads observation date and airmass from the header of a fits image,
+    without reading its data units
+    """
+    header = fits.getheader(file, ext=1)
+    return (
+        file, os.stat(file).st_mtime_ns,
+        header['HIERARCH OAJ PRO REFDATEOBS'],
+        header['HIERARCH OAJ PRO REFAIRMASS'])
+
+
+def get_metadata(folder_pattern, save_file, n_jobs=8):
+    """
+    indexes date and airmass of fits images
+    only headers are read, across n_jobs processes, and files whose path and
+    modification time are already in save_file are not read again
+    receives:
+        * folder_pattern    (str) path pattern to get fits.fz field images
+        * save_file         (str) .csv or .parquet table with columns
+                            path, mtime, file, field, band, date, airmass, year
+    """
     files = glob(folder_pattern)
     files.sort()
     print('nr of files', len(files))
-    dates = []
-    airmasses = []
-    for f in files:
-        im = fits.open(f)
-        dates.append(im[1].header['HIERARCH OAJ PRO REFDATEOBS'])
-        airmasses.append(im[1].header['HIERARCH OAJ PRO REFAIRMASS'])
-    df = pd.DataFrame({'file': files, 'date': dates, 'airmass': airmasses})
-    df.to_csv(save_file, index=False)
-    print('saved csv')
-    df['file'] = df.file.apply(lambda s: s.split('/')[-1])
-    df['field'] = df.file.apply(lambda s: s.split('_')[0])
-    df['band'] = df.file.apply(lambda s: s.split('_')[1])
-    df['year'] = df.date.apply(lambda s: s.split('-')[0])
-    df.to_csv(save_file, index=False)
-    print('saved csv again')
-
-
-def crop_objects_in_rgb(catalog_path, input_folder, save_folder, size=32, fwhm_radius=1.5):
+
+    cols = ['path', 'mtime', 'date', 'airmass']
+    cached = pd.DataFrame(columns=cols)
+    if os.path.exists(save_file):
+        saved = read_table(save_file)
+        # tables saved before path and mtime were indexed are not reused
+        if set(cols).issubset(saved.columns):
+            mtimes = {f: os.stat(f).st_mtime_ns for f in files}
+            cached = saved.loc[[mtimes.get(p) == m for p, m in zip(saved.path, saved.mtime)], cols]
+    new_files = sorted(set(files) - set(cached.path))
+    print('nr of files to index', len(new_files))
+
+    rows = Parallel(n_jobs=n_jobs, batch_size=64)(
+        delayed(read_header_metadata)(f) for f in new_files)
+    df = pd.concat(
+        [cached, pd.DataFrame(rows, columns=cols)], ignore_index=True)
+    df = df.sort_values(by='path').reset_index(drop=True)
+
+    df['mtime'] = df.mtime.astype(np.int64)
+    df['date'] = df.date.astype(str)
+    df['airmass'] = df.airmass.astype(np.float64)
+    df['file'] = df.path.str.split('/').str[-1]
+    df['field'] = df.file.str.split('_').str[0].astype('category')
+    df['band'] = df.file.str.split('_').str[1].astype('category')
+    df['year'] = df.date.str.split('-').str[0].astype(np.int16)
+    write_table(df, save_file)
+    print('saved', save_file)
+
+
+def crop_objects_in_rgb(
+        catalog_path, input_folder, save_folder, size=32, fwhm_radius=1.5,
+        archive=False, n_jobs=8):
+    """
+    crops objects in rgb trilogy images
+    each trilogy image is decoded once and all of its objects are cropped in
+    a batch; objects near the image borders are clipped and resized
+    receives:
+        * archive       (bool) whether to store crops in a CropArchive in
+                        save_folder instead of one .png per object; archives
+                        store crops in RGB order, as read from the .png files
+                        by skimage, and record it as channel_order in their meta
+        * n_jobs        (int) number of threads encoding .png files
+    """
     d = size // 2
     df = pd.read_csv(catalog_path)
     print('df (original)', df.shape)
@@ -44,33 +101,155 @@ def crop_objects_in_rgb(catalog_path, input_folder, save_folder, size=32, fwhm_r
 
     df['X'] = df.x
     df['Y'] = 11000 - df.y
-    df['field'] = df.id.apply(lambda s: s.split('.')[0])
+    df['field'] = df.id.str.split('.').str[0]
 
     # ignore objects that have already been cropped
-    imgfiles = glob(save_folder + '*/*.png')
-    imgfiles = [i.split('/')[-1][:-4] for i in imgfiles]
-    df = df[~df.id.isin(imgfiles)]
+    if archive:
+        crop_archive = CropArchive(save_folder, shape=(size, size, 3), dtype=np.uint8)
+        if 'channel_order' not in crop_archive.meta:
+            crop_archive.meta['channel_order'] = 'rgb'
+            crop_archive.save_meta()
+    manifest = CropManifest(save_folder, get_crop_params(size, rgb=True))
+    if len(manifest) == 0 and not archive:
+        # .png crops made before manifests existed are recorded once; they are
+        # the same as crops made now
+        imgfiles = glob(save_folder + '*/*.png')
+        manifest.add([i.split('/')[-1][:-4] for i in imgfiles])
+    df = df[manifest.select_new(df.id.values)]
     print('df after ignoring existing crops', df.shape)
 
     df = df.sort_values(by='id')
 
-    lst_field = ''
-    for ix, r in df.iterrows():
-        field = r['field']
-        if field != lst_field:
-            imgfile = input_folder + '{}_trilogy.png'.format(field)
-            print('cropping objects in', imgfile)
-            fullimg = imread(imgfile)
-            if not os.path.exists(save_folder + field):
-                os.makedirs(save_folder + field)
-        lst_field = field
-        # d = np.ceil(np.maximum(radius, fwhm_radius * r['fwhm'])).astype(np.int)
-        img = fullimg[r['Y'] - d:r['Y'] + d, r['X'] - d:r['X'] + d]
-        if img.shape[0] != size or img.shape[1] != size:
-            img = resize(img, dsize=(size, size), interpolation=INTER_CUBIC)
-            print('resized', r['id'])
-        # print('saving {}'.format(r['id']))
-        imwrite('{}{}/{}.png'.format(save_folder, r['field'], r['id']), img)
+    for field, objects_df in df.groupby('field', sort=False):
+        imgfile = input_folder + '{}_trilogy.png'.format(field)
+        print('cropping objects in', imgfile)
+        fullimg = imread(imgfile)
+        ids = list(objects_df.id.values)
+        # fixed windows of half-width d, i.e., fwhm is not used
+        crops = crop_objects_in_field(
+            fullimg, objects_df.X.values, objects_df.Y.values,
+            np.zeros(len(ids)), size, radius=d)
+        if archive:
+            # cv2 decodes BGR
+            crops = crops[..., ::-1]
+            crop_archive.append(field, ids, crops)
+        else:
+            save_rgb_crops(ids, crops, save_folder + field, n_jobs)
+        manifest.add(ids, [get_checksum(c) for c in crops])
+
+
+def save_rgb_crops(ids, crops, save_folder, n_jobs=8):
+    """
+    saves crops as .png files in save_folder using n_jobs threads
+    """
+    if not os.path.exists(save_folder):
+        os.makedirs(save_folder)
+    Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(imwrite)('{}/{}.png'.format(save_folder, ids[i]), crops[i])
+        for i in range(len(ids)))
+
+
+def get_crop_params(
+        size=32, radius=16, fwhm_radius=1.5, calibrate=True, asinh=False, rgb=False,
+        transforms=None):
+    """
+    returns the string that identifies crop parameters in a CropManifest
+    """
+    if rgb:
+        return 'size={};rgb=1'.format(size)
+    params = 'size={};radius={};fwhm_radius={};calibrate={:d};asinh={:d}'.format(
+        size, radius, fwhm_radius, calibrate, asinh)
+    if transforms is not None:
+        params += ';transforms=' + describe_transforms(transforms)
+    return params
+
+
+def get_crop_transforms(calibrate=True, asinh=False, transforms=None):
+    """
+    returns the chain of transforms applied to crops after cropping
+    receives:
+        * calibrate     (bool) whether fields are calibrated when assembled
+        * asinh         (bool) shorthand for transforms=['asinh']
+        * transforms    (list) steps, see transforms.compile_transforms
+    """
+    if transforms is None:
+        return ['asinh'] if asinh else []
+    if asinh:
+        raise ValueError('asinh must be given as a step of transforms')
+    names = [get_step(step)[0] for step in transforms]
+    if calibrate and 'calibrate' in names:
+        raise ValueError('fields are already calibrated; use calibrate=False')
+    return list(transforms)
+
+
+def get_half_widths(fwhm, radius=16, fwhm_radius=1.5, max_half=MAX_HALF_WIDTH):
+    """
+    returns the integer half-widths of crop windows: radius, or fwhm_radius
+    times fwhm for larger objects, capped at max_half
+    """
+    d = np.ceil(np.maximum(radius, fwhm_radius * np.asarray(fwhm))).astype(int)
+    return np.minimum(d, max_half)
+
+
+def crop_window(arr, x, y, fwhm, size=32, radius=16, fwhm_radius=1.5):
+    """
+    crops the window around (x, y) in arr, resized to (size, size)
+    """
+    d = int(get_half_widths(fwhm, radius, fwhm_radius))
+    x0 = np.maximum(0, int(x) - d)
+    x1 = np.minimum(arr.shape[1] - 1, int(x) + d)
+    y0 = np.maximum(0, int(y) - d)
+    y1 = np.minimum(arr.shape[0] - 1, int(y) + d)
+    im = arr[y0:y1, x0:x1, :]
+    if im.shape[0] != size or im.shape[1] != size:
+        im = resize(np.ascontiguousarray(im), dsize=(size, size), interpolation=INTER_CUBIC)
+    return im
+
+
+def crop_objects_in_field(
+        arr, x, y, fwhm, size=32, radius=16, fwhm_radius=1.5, transforms=None):
+    """
+    crops a batch of objects in a given field
+    windows of the same half-width are extracted at once from a strided view
+    of arr, and those that need resizing are resized together by stacking
+    them along the channel axis, as many as cv2 accepts per call
+    receives:
+        * arr           (ndarray) full field image, (s0, s1, n_channels)
+        * x, y, fwhm    (ndarray) columns of the objects to be cropped
+        * transforms    (list) steps applied in place to the resized crops,
+                        see transforms.compile_transforms
+    returns:
+        (n, size, size, n_channels) ndarray with one crop per object
+    """
+    x = np.asarray(x).astype(int)
+    y = np.asarray(y).astype(int)
+    d = get_half_widths(fwhm, radius, fwhm_radius)
+    s0, s1, n_channels = arr.shape
+    crops = np.empty((len(x), size, size, n_channels), dtype=arr.dtype)
+    batch_size = max(1, CV_MAX_CHANNELS // n_channels)
+
+    inside = (x - d >= 0) & (x + d < s1) & (y - d >= 0) & (y + d < s0)
+    for i in np.flatnonzero(~inside):
+        crops[i] = crop_window(arr, x[i], y[i], d[i], size, radius=0, fwhm_radius=1)
+
+    for dd in np.unique(d[inside]):
+        idx = np.flatnonzero(inside & (d == dd))
+        windows = sliding_window_view(arr, (2 * dd, 2 * dd), axis=(0, 1))
+        for b in range(0, len(idx), batch_size):
+            idx_b = idx[b:b + batch_size]
+            # (k, n_channels, 2d, 2d) -> (k, 2d, 2d, n_channels)
+            batch = windows[y[idx_b] - dd, x[idx_b] - dd].transpose(0, 2, 3, 1)
+            if 2 * dd != size:
+                k = len(idx_b)
+                batch = np.ascontiguousarray(batch.transpose(1, 2, 0, 3)).reshape(
+                    2 * dd, 2 * dd, k * n_channels)
+                batch = resize(batch, dsize=(size, size), interpolation=INTER_CUBIC)
+                batch = batch.reshape(size, size, k, n_channels).transpose(2, 0, 1, 3)
+            crops[idx_b] = batch
+
+    if transforms:
+        crops = apply_transforms(crops, compile_transforms(transforms))
+    return crops
 
 
 def crop_object_in_field(
@@ -89,23 +268,155 @@ def crop_object_in_field(
     but yields too many resizes.
     """
     row = objects_df.loc[obj_ix]
-    d = np.ceil(np.maximum(radius, fwhm_radius * row['fwhm'])).astype(np.int)
-    d = np.minimum(d, 75)  # 75 = 3 *(largest fwhm with photoflag==0) / 2
-    x0 = np.maximum(0, int(row['x']) - d)
-    x1 = np.minimum(10999, int(row['x']) + d)
-    y0 = np.maximum(0, int(row['y']) - d)
-    y1 = np.minimum(10999, int(row['y']) + d)
-    im = arr[y0:y1, x0:x1, :]
-    if im.shape[0] != size or im.shape[1] != size:
-        im = resize(im, dsize=(size, size), interpolation=INTER_CUBIC)
-        print('{} resized'.format(row['id']))
+    im = crop_window(arr, row['x'], row['y'], row['fwhm'], size, radius, fwhm_radius)
     if asinh:
-        im = asinh_transform(im, clip=False)
+        im = apply_transforms(im, compile_transforms(['asinh']))
     np.save('{}/{}.npy'.format(save_folder, row['id']), im)
 
     return 0
 
 
+def get_free_space(folder):
+    stat = os.statvfs(folder)
+    return stat.f_bavail * stat.f_frsize
+
+
+def reserve_file(path):
+    """
+    allocates all blocks of a (sparse) file, raising OSError when the file
+    system is full, instead of a SIGBUS when its pages are first written
+    """
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.posix_fallocate(fd, 0, os.path.getsize(path))
+    finally:
+        os.close(fd)
+
+
+def create_shared_array(shape, dtype=np.float32, fallback_folder=None):
+    """
+    creates a .npy memmap in shared memory (/dev/shm, when available)
+    that worker processes can open by filename without copying it
+    its space is reserved up front; when shared memory has not enough free
+    space, e.g., in containers or with several fields at once, the array is
+    created in fallback_folder (the temp folder by default) instead, and an
+    OSError is raised when neither has enough free space
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    folders = [f for f in [SHM_DIR, fallback_folder or gettempdir()] if f is not None]
+    for folder in folders:
+        if get_free_space(folder) < nbytes:
+            print('not enough free space in', folder)
+            continue
+        fd, path = mkstemp(suffix='.npy', dir=folder)
+        os.close(fd)
+        arr = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        try:
+            reserve_file(path)
+        except OSError as e:
+            # another process took the space since it was checked
+            arr = None
+            os.remove(path)
+            print('could not reserve space in', folder, e)
+            continue
+        return arr
+    raise OSError('not enough free space for a {:.1f} GiB array in {}'.format(
+        nbytes / 2**30, ' or '.join(folders)))
+
+
+def remove_shared_array(arr):
+    os.remove(arr.filename)
+
+
+def crop_objects_range(
+        cube_file, ids, x, y, fwhm, save_folder, transforms=None,
+        size=32, radius=16, fwhm_radius=1.5, shard=None):
+    """
+    crops a range of objects in a field cube stored as a .npy file
+    receives:
+        * cube_file     (str) .npy file with the 12-band full field image
+        * ids, x, y, fwhm   (ndarray) columns of the objects to be cropped
+        * save_folder   (str) path to folder where crops will be saved
+        * shard         (str) if given, crops are appended to this shard of
+                        the CropArchive in save_folder instead of .npy files
+    returns:
+        a tuple (ids, checksums) of the saved crops
+    """
+    arr = np.load(cube_file, mmap_mode='r')
+    crops = crop_objects_in_field(
+        arr, x, y, fwhm, size, radius, fwhm_radius, transforms)
+    return save_crops(ids, crops, save_folder, shard)
+
+
+def save_crops(ids, crops, save_folder, shard=None):
+    """
+    saves crops as .npy files in save_folder, or appends them to a shard of
+    the CropArchive in save_folder
+    returns:
+        a tuple (ids, checksums) of the saved crops
+    """
+    if shard is not None:
+        CropArchive(save_folder).append(shard, list(ids), crops)
+    else:
+        for i in range(len(ids)):
+            np.save('{}/{}.npy'.format(save_folder, ids[i]), crops[i])
+    return list(ids), [get_checksum(c) for c in crops]
+
+
+def crop_field(
+        arr, objects_df, save_folder, transforms=None, n_jobs=8, chunk_size=1000,
+        archive=False):
+    """
+    crops all objects of objects_df in a field using n_jobs workers
+    workers open the field as a read-only memmap and receive only the
+    columns of their range of chunk_size objects
+    receives:
+        * arr           (ndarray) 12-band full field image; arrays that are not
+                        a memmap of a .npy file are first copied to shared memory
+        * objects_df    (pandas DataFrame) objects in the field
+        * save_folder   (str) path to folder where crops will be saved
+        * transforms    (list) steps applied to crops, see get_crop_transforms
+        * n_jobs        (int) number of worker processes
+        * chunk_size    (int) number of objects per worker task
+        * archive       (bool) whether save_folder is a CropArchive; each task
+                        then appends to its own <field>_<chunk> shard
+    returns:
+        a tuple (ids, checksums) of the saved crops
+    """
+    shared = None
+    if not isinstance(arr, np.memmap) or arr.filename is None or arr.offset == 0:
+        shared = create_shared_array(arr.shape, arr.dtype)
+        shared[:] = arr
+        arr = shared
+
+    ids = objects_df['id'].values
+    x = objects_df['x'].values
+    y = objects_df['y'].values
+    fwhm = objects_df['fwhm'].values
+    field = ids[0].split('.')[0] if len(ids) > 0 else ''
+    transforms = bind_transforms(transforms, field)
+    try:
+        results = Parallel(n_jobs=n_jobs)(delayed(crop_objects_range)(
+            arr.filename, ids[i:i + chunk_size], x[i:i + chunk_size],
+            y[i:i + chunk_size], fwhm[i:i + chunk_size], save_folder,
+            transforms, shard='{}_{}'.format(field, i // chunk_size) if archive else None)
+            for i in range(0, len(ids), chunk_size))
+    finally:
+        if shared is not None:
+            remove_shared_array(shared)
+    return merge_crop_results(results)
+
+
+def merge_crop_results(results):
+    ids, checksums = [], []
+    for task_ids, task_checksums in results:
+        ids.extend(task_ids)
+        checksums.extend(task_checksums)
+    return ids, checksums
+
+
 def get_bands_order():
     """
     maps desired depthwise position to alphabetical index
@@ -133,15 +444,134 @@ def get_bands():
             'F515', 'R', 'F660', 'I', 'F861', 'Z']
 
 
-def get_zps(field):
-    zpfile = os.path.join(
-        os.environ['DATA_PATH'],
-        'dr1/ZPfiles_Feb2019', '{}_ZP.cat'.format(field))
-    zpdata = Table.read(zpfile, format="ascii")
-    zps = dict([(t['FILTER'], t['ZP']) for t in zpdata])
+def read_zp_file(zpfile):
+    """
+    returns a dict mapping each filter in a {field}_ZP.cat file to its zero point
+    """
+    zps = {}
+    columns = None
+    with open(zpfile) as f:
+        for line in f:
+            values = line.split()
+            if len(values) == 0 or values[0].startswith('#'):
+                continue
+            if columns is None:
+                columns = values
+                continue
+            zps[values[columns.index('FILTER')]] = float(values[columns.index('ZP')])
     return zps
 
 
+def get_zp_table(zp_folder=None, cache_file=None):
+    """
+    returns all zero points of a release as a (fields, bands, zps) tuple, where
+    zps is a (len(fields), len(bands)) float array, NaN for missing bands
+    the table is kept in memory and persisted to cache_file (zps.npz in
+    zp_folder by default) along with the mtime of each ZP file; files that
+    are new or changed since the cache was written are parsed again
+    receives:
+        * zp_folder     (str) folder with {field}_ZP.cat files; default is the
+                        DR1 folder in DATA_PATH
+        * cache_file    (str) .npz file wherein the table is persisted
+    """
+    if zp_folder is None:
+        zp_folder = os.path.join(os.environ['DATA_PATH'], 'dr1/ZPfiles_Feb2019')
+    if zp_folder in zp_tables:
+        return zp_tables[zp_folder]
+    if cache_file is None:
+        cache_file = os.path.join(zp_folder, 'zps.npz')
+
+    # sorted by field name, as lookup_zps searches fields; paths sort
+    # differently, e.g., STRIPE82-00012_ZP.cat before STRIPE82-0001_ZP.cat
+    zpfiles = glob(os.path.join(zp_folder, '*_ZP.cat'))
+    zpfiles = sorted(zpfiles, key=lambda f: f.split('/')[-1][:-len('_ZP.cat')])
+    fields = np.array([f.split('/')[-1][:-len('_ZP.cat')] for f in zpfiles])
+    mtimes = np.array([os.stat(f).st_mtime_ns for f in zpfiles], dtype=np.int64)
+
+    cached = {}
+    bands = get_bands()
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as npz:
+            if list(npz['bands']) == bands:
+                for field, mtime, row in zip(npz['fields'], npz['mtimes'], npz['zps']):
+                    cached[field] = (mtime, row)
+
+    zps = np.full((len(fields), len(bands)), np.nan)
+    n_parsed = 0
+    for i, (field, mtime) in enumerate(zip(fields, mtimes)):
+        if field in cached and cached[field][0] == mtime:
+            zps[i] = cached[field][1]
+            continue
+        field_zps = read_zp_file(zpfiles[i])
+        zps[i] = [field_zps.get(b, np.nan) for b in bands]
+        n_parsed += 1
+
+    if n_parsed > 0 or len(cached) != len(fields):
+        try:
+            tmp_file = cache_file + '.tmp.npz'
+            np.savez(tmp_file, fields=fields, bands=np.array(bands), mtimes=mtimes, zps=zps)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            print('zero points not cached:', e)
+
+    zp_tables[zp_folder] = (fields, bands, zps)
+    return zp_tables[zp_folder]
+
+
+def lookup_zps(fields, bands=None, zp_folder=None):
+    """
+    returns the zero points of many fields at once
+    receives:
+        * fields        (list) field names
+        * bands         (list) bands to be returned; default is get_bands()
+        * zp_folder     (str) see get_zp_table
+    returns:
+        (len(fields), len(bands)) float array
+    """
+    table_fields, table_bands, zps = get_zp_table(zp_folder)
+    fields = np.asarray(fields)
+    ix = np.searchsorted(table_fields, fields)
+    ix = np.minimum(ix, len(table_fields) - 1)
+    missing = table_fields[ix] != fields if len(table_fields) > 0 else np.ones(len(fields), bool)
+    if missing.any():
+        raise KeyError('no zero points for fields {}'.format(fields[missing].tolist()))
+    if bands is None:
+        return zps[ix]
+    return zps[np.ix_(ix, [table_bands.index(b) for b in bands])]
+
+
+def get_zps(field):
+    """
+    returns a dict mapping each band of field to its zero point
+    """
+    _, bands, _ = get_zp_table()
+    return {b: zp for b, zp in zip(bands, lookup_zps([field])[0]) if not np.isnan(zp)}
+
+
+def get_calibration_scales(field):
+    """
+    returns the (n_channels,) float32 factors that calibrate the bands of a
+    field, ordered as get_bands
+    """
+    return get_calibration_scale(lookup_zps([field])[0]).astype(np.float32)
+
+
+def bind_transforms(transforms, field):
+    """
+    returns a copy of transforms wherein calibrate steps are bound to the
+    zero points of field
+    """
+    if not transforms:
+        return transforms
+    bound = []
+    for step in transforms:
+        name, params = get_step(step)
+        if name == 'calibrate' and 'zps' not in params:
+            params['zps'] = lookup_zps([field])[0].tolist()
+        bound.append((name, params))
+    return bound
+
+
 def make_calibration(data, zp):
     """
     applies corrections to given data (image) according to given zp (zero-point) value
@@ -151,24 +581,312 @@ def make_calibration(data, zp):
     returns :
         * S    (np array)  bidimensional calibrated image
     """
-    ps = 0.55  # pixel scale [arcsec / pixel]
-    fnu = data * np.power(10, -0.4 * zp)  # spectral flux density
-    # Surface brightness using fnu
-    S = 1e5 * fnu / ps**2  # [1e5 erg / (s cm^2 Hz arcsec^2)]
-    return S
+    # surface brightness [1e5 erg / (s cm^2 Hz arcsec^2)] from the spectral
+    # flux density data * 10^(-0.4 zp) and the pixel scale
+    return data * get_calibration_scale(zp)
+
+
+def group_files_by_field(files):
+    """
+    groups band files by field name
+    receives:
+        * files     (list) paths to fits.fz images named <field>_<band>_*.fz
+    returns:
+        a dict mapping each field name to its alphabetically sorted band files
+    """
+    fields = {}
+    for f in sorted(files):
+        field = f.split('/')[-1].split('_')[0]
+        fields.setdefault(field, []).append(f)
+    return fields
+
+
+def assemble_field(field_files, out, calibrate=True, block_rows=1000):
+    """
+    fills out with the 12-band cube of a field, band-ordered by get_bands_order
+    bands are read in blocks of rows, so that only block_rows rows of every
+    band are decompressed and held in memory at once
+    receives:
+        * field_files   (list) alphabetically sorted band files of one field
+        * out           (ndarray) (s0, s1, n_channels) array or memmap
+        * calibrate     (bool) whether to apply make_calibration to each band
+        * block_rows    (int) number of rows read per block
+    """
+    bands_order = get_bands_order()
+    if len(field_files) != len(bands_order):
+        raise ValueError('expected {} band files, but {} were given'.format(
+            len(bands_order), len(field_files)))
+
+    if calibrate:
+        field = field_files[0].split('/')[-1].split('_')[0]
+        scales = get_calibration_scales(field)
+
+    hduls = [fits.open(f) for f in field_files]
+    try:
+        for r0 in range(0, out.shape[0], block_rows):
+            r1 = min(r0 + block_rows, out.shape[0])
+            for j, i in enumerate(bands_order):
+                data = hduls[i][1].section[r0:r1, :]
+                if calibrate:
+                    np.multiply(data, scales[j], out=out[r0:r1, :, j])
+                else:
+                    out[r0:r1, :, j] = data
+    finally:
+        for hdul in hduls:
+            hdul.close()
+    return out
+
+
+def get_cube_path(cube_folder, field, calibrate=True):
+    suffix = '' if calibrate else '_raw'
+    return os.path.join(cube_folder, '{}{}.npy'.format(field, suffix))
+
+
+def get_cube_sources(field_files, calibrate=True):
+    """
+    returns what a field cube is built from: the mtimes of its band files
+    and, if calibrated, the zero points of the field
+    """
+    sources = {'mtimes': [os.stat(f).st_mtime_ns for f in field_files]}
+    if calibrate:
+        field = field_files[0].split('/')[-1].split('_')[0]
+        # missing zero points as None, since NaN never compares equal
+        sources['zps'] = [None if np.isnan(zp) else float(zp) for zp in lookup_zps([field])[0]]
+    return sources
+
+
+def build_field_cube(field_files, cube_path, calibrate=True, sources=None):
+    """
+    writes the 12-band cube of a field to a .npy file that can be memory-mapped
+    the cube is written to a temporary file first and moved into place when
+    complete, so an interrupted run never leaves a partial cube behind;
+    its sources (see get_cube_sources) are then saved next to it, in a .json
+    file with the same name
+    receives:
+        * field_files   (list) alphabetically sorted band files of one field
+        * cube_path     (str) path of the .npy file to be written
+        * calibrate     (bool) whether to apply make_calibration to each band
+    """
+    if sources is None:
+        sources = get_cube_sources(field_files, calibrate)
+    with fits.open(field_files[0]) as hdul:
+        s0, s1 = hdul[1].shape
+    tmp_path = cube_path + '.tmp'
+    cube = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.float32,
+        shape=(s0, s1, len(get_bands_order())))
+    assemble_field(field_files, cube, calibrate)
+    cube.flush()
+    del cube
+    os.replace(tmp_path, cube_path)
+    sources_file = cube_path[:-len('.npy')] + '.json'
+    with open(sources_file + '.tmp', 'w') as f:
+        json.dump(sources, f)
+    os.replace(sources_file + '.tmp', sources_file)
+
+
+def load_field_cube(field_files, cube_folder, calibrate=True):
+    """
+    returns a read-only memmap of the 12-band cube of a field,
+    building and caching it in cube_folder on first use
+    a cached cube is built again when its band files or zero points changed
+    since it was built, or when it has no sources file
+    receives:
+        * field_files   (list) alphabetically sorted band files of one field
+        * cube_folder   (str) folder wherein field cubes are cached
+        * calibrate     (bool) whether the cube is zero-point calibrated
+    """
+    field = field_files[0].split('/')[-1].split('_')[0]
+    cube_path = get_cube_path(cube_folder, field, calibrate)
+    sources_file = cube_path[:-len('.npy')] + '.json'
+    sources = get_cube_sources(field_files, calibrate)
+    cached_sources = None
+    if os.path.exists(cube_path) and os.path.exists(sources_file):
+        with open(sources_file) as f:
+            cached_sources = json.load(f)
+    if cached_sources != sources:
+        if not os.path.exists(cube_folder):
+            os.makedirs(cube_folder)
+        print('caching cube of', field)
+        build_field_cube(field_files, cube_path, calibrate, sources)
+    return np.load(cube_path, mmap_mode='r')
+
+
+def get_tile_shape(field_file):
+    """
+    returns the (rows, cols) of the compression tiles of a fits.fz image
+    """
+    header = fits.getheader(field_file, 1, disable_image_compression=True)
+    return header.get('ZTILE2', 1), header.get('ZTILE1', header['ZNAXIS1'])
+
+
+def read_field_region(field_files, y0, y1, x0, x1, calibrate=True):
+    """
+    reads rows y0:y1 and columns x0:x1 of the 12 bands of a field,
+    decompressing only the tiles that intersect the region
+    returns:
+        (y1 - y0, x1 - x0, n_channels) float32 array, band-ordered by
+        get_bands_order
+    """
+    bands_order = get_bands_order()
+    if calibrate:
+        field = field_files[0].split('/')[-1].split('_')[0]
+        scales = get_calibration_scales(field)
+    region = np.empty((y1 - y0, x1 - x0, len(bands_order)), dtype=np.float32)
+    for j, i in enumerate(bands_order):
+        with fits.open(field_files[i]) as hdul:
+            data = hdul[1].section[y0:y1, x0:x1]
+        if calibrate:
+            np.multiply(data, scales[j], out=region[:, :, j])
+        else:
+            region[:, :, j] = data
+    return region
+
+
+def crop_objects_tiled(
+        field_files, field_shape, ids, x, y, fwhm, save_folder, calibrate=True,
+        transforms=None, size=32, radius=16, fwhm_radius=1.5, shard=None):
+    """
+    crops a group of nearby objects reading only the region that covers their
+    windows from the band files, instead of the full field
+    receives:
+        * field_files   (list) alphabetically sorted band files of one field
+        * field_shape   (tuple) (s0, s1) shape of the field
+        * ids, x, y, fwhm   (ndarray) columns of the objects to be cropped
+        * save_folder   (str) path to folder where crops will be saved
+        * shard         (str) if given, crops are appended to this shard of
+                        the CropArchive in save_folder instead of .npy files
+    returns:
+        a tuple (ids, checksums) of the saved crops
+    """
+    xi = np.asarray(x).astype(int)
+    yi = np.asarray(y).astype(int)
+    d = get_half_widths(fwhm, radius, fwhm_radius)
+    # one extra row/column, so that windows inside the field are also inside
+    # the region and are clipped exactly as they would be in the full field
+    y0 = max(0, (yi - d).min())
+    y1 = min(field_shape[0], (yi + d).max() + 1)
+    x0 = max(0, (xi - d).min())
+    x1 = min(field_shape[1], (xi + d).max() + 1)
+    region = read_field_region(field_files, y0, y1, x0, x1, calibrate)
+    crops = crop_objects_in_field(
+        region, xi - x0, yi - y0, fwhm, size, radius, fwhm_radius, transforms)
+    return save_crops(ids, crops, save_folder, shard)
+
+
+def crop_field_tiled(
+        field_files, objects_df, save_folder, calibrate=True, transforms=None,
+        n_jobs=8, tile_size=256, archive=False):
+    """
+    crops all objects of objects_df in a field without assembling the field
+    objects are grouped by cells that follow the compression tiles of the
+    band files (full-width strips for row-tiled images), and each group is
+    cropped from the region that covers it, so that only tiles that
+    intersect object windows are decompressed
+    receives:
+        * field_files   (list) alphabetically sorted band files of one field
+        * objects_df    (pandas DataFrame) objects in the field
+        * save_folder   (str) path to folder where crops will be saved
+        * tile_size     (int) minimum height and width of a group cell
+        * archive       (bool) whether save_folder is a CropArchive; each group
+                        then appends to its own <field>_t<group> shard
+    returns:
+        a tuple (ids, checksums) of the saved crops
+    """
+    with fits.open(field_files[0]) as hdul:
+        field_shape = hdul[1].shape
+    tile_rows, tile_cols = get_tile_shape(field_files[0])
+    cell_rows = int(np.ceil(tile_size / tile_rows)) * tile_rows
+    cell_cols = int(np.ceil(tile_size / tile_cols)) * tile_cols
 
+    ids = objects_df['id'].values
+    x = objects_df['x'].values
+    y = objects_df['y'].values
+    fwhm = objects_df['fwhm'].values
+    n_cols = field_shape[1] // cell_cols + 1
+    cells = (y.astype(int) // cell_rows) * n_cols + x.astype(int) // cell_cols
+    field = ids[0].split('.')[0] if len(ids) > 0 else ''
+    transforms = bind_transforms(transforms, field)
+    groups = [np.flatnonzero(cells == c) for c in np.unique(cells)]
+    results = Parallel(n_jobs=n_jobs)(delayed(crop_objects_tiled)(
+        field_files, field_shape, ids[g], x[g], y[g], fwhm[g], save_folder,
+        calibrate, transforms, shard='{}_t{}'.format(field, k) if archive else None)
+        for k, g in enumerate(groups))
+    return merge_crop_results(results)
 
-def sweep_fields(fields_path, catalog_path, crops_folder, calibrate=True, asinh=False):
+
+def sweep_field(
+        field_files, objects_df, crops_folder, calibrate=True, transforms=None,
+        cube_folder=None, n_jobs=8, archive=False, tiled=False):
+    """
+    crops all objects of one field; see sweep_fields for the parameters
+    returns:
+        a tuple (field, ids, checksums) of the saved crops
+    """
+    field = field_files[0].split('/')[-1].split('_')[0]
+    save_folder = crops_folder if archive else crops_folder + field
+    if not os.path.exists(save_folder):
+        os.makedirs(save_folder)
+
+    if tiled:
+        return (field,) + crop_field_tiled(
+            field_files, objects_df, save_folder, calibrate, transforms, n_jobs,
+            archive=archive)
+
+    if cube_folder is not None:
+        arr = load_field_cube(field_files, cube_folder, calibrate)
+        return (field,) + crop_field(
+            arr, objects_df, save_folder, transforms, n_jobs, archive=archive)
+
+    # assembled directly in shared memory, so that crop workers can read
+    # the field without copies
+    with fits.open(field_files[0]) as hdul:
+        s0, s1 = hdul[1].shape
+    arr = create_shared_array((s0, s1, len(get_bands_order())))
+    try:
+        assemble_field(field_files, arr, calibrate)
+        return (field,) + crop_field(
+            arr, objects_df, save_folder, transforms, n_jobs, archive=archive)
+    finally:
+        remove_shared_array(arr)
+
+
+def sweep_fields(
+        fields_path, catalog_path, crops_folder, calibrate=True, asinh=False,
+        cube_folder=None, n_jobs=8, archive=False, tiled=False, max_fields=1,
+        transforms=None):
     """
     sweeps field images cropping and saving objects in fields
+    up to max_fields fields are processed at once, each in its own process,
+    and the crops of a field are committed to the manifest in a single append
+    when the whole field is done, so an interrupted sweep resumes at the first
+    unfinished field
     receives:
         * fields_path   (str) path pattern to get fits.fz field images
         * catalog_path  (str) catalog where x,y coordinates for objects are stored
         * crops_folder  (str) folder where image crops will be saved
+        * cube_folder   (str) optional folder wherein calibrated field cubes are
+                        cached as memory-mapped .npy files; fields with an
+                        up-to-date cached cube are not decompressed again
+        * n_jobs        (int) number of workers cropping each field; these are
+                        threads of the field process when max_fields > 1
+        * archive       (bool) whether to store crops in a CropArchive in
+                        crops_folder instead of one .npy per object; an archive
+                        holds crops of a single params string, see get_crop_params
+        * tiled         (bool) whether to read only the tiles of band files that
+                        intersect object windows instead of whole fields; best
+                        for sparse catalogs
+        * max_fields    (int) maximum number of fields processed concurrently,
+                        i.e., of full field cubes resident in memory
+        * transforms    (list) chain of transforms applied to crops in place,
+                        e.g., ['asinh', ('clip', {'lower': 0, 'upper': 1})];
+                        replaces asinh, see get_crop_transforms. With
+                        calibrate=False, a 'calibrate' step calibrates crops
+                        instead, so variants are cropped from one raw cube
     """
+    crop_transforms = get_crop_transforms(calibrate, asinh, transforms)
 
     files = glob(fields_path, recursive=True)
-    files.sort()
 
     print('reading catalog')
     df = pd.read_csv(catalog_path)
@@ -179,156 +897,182 @@ def sweep_fields(fields_path, catalog_path, crops_folder, calibrate=True, asinh=
     df['field_name'] = df['id'].apply(lambda s: s.split('.')[0])
 
     # ignore objects that have already been cropped
-    imgfiles = glob(crops_folder + '*/*.npy')
-    imgfiles = [i.split('/')[-1][:-4] for i in imgfiles]
+    params = get_crop_params(calibrate=calibrate, asinh=asinh, transforms=transforms)
+    if archive:
+        crop_archive = CropArchive(crops_folder, shape=(32, 32, 12), dtype=np.float32)
+        archive_params = crop_archive.meta.get('params')
+        if archive_params is not None and archive_params != params:
+            raise ValueError('{} holds crops made with {}, not {}; use another crops_folder'.format(
+                crops_folder, archive_params, params))
+        if archive_params is None:
+            crop_archive.meta['params'] = params
+            crop_archive.save_meta()
+    manifest = CropManifest(crops_folder, params)
+    if len(manifest) == 0:
+        # crops made before manifests existed are recorded once, as legacy
+        # crops, since they may have another band order or calibration
+        if archive:
+            manifest.add(list(crop_archive.index()), params=CropManifest.legacy_params)
+        else:
+            imgfiles = glob(crops_folder + '*/*.npy')
+            manifest.add([i.split('/')[-1][:-4] for i in imgfiles], params=CropManifest.legacy_params)
     print('df', df.shape)
-    df = df[~df.id.isin(imgfiles)]
+    df = df[manifest.select_new(df.id.values)]
     print('df after ignoring existing crops', df.shape)
     fields = np.unique(df.field_name.values)
-    files_orig = files
-    files = []
-    for field in fields:
-        files_tmp = [f for f in files_orig if field in f]
-        files = files + files_tmp
-    del files_orig
-
-    if len(files) == 0:
+    field_files = group_files_by_field(files)
+    field_files = {f: field_files[f] for f in fields if f in field_files}
+
+    if len(field_files) == 0:
         print('all objects already have crops')
         return
 
-    bands_order = get_bands_order()
-    bands = get_bands()
-    n_channels = len(bands_order)
+    print('nr of fields to sweep', len(field_files))
+    start = time()
+    results = Parallel(n_jobs=max_fields, return_as='generator_unordered')(
+        delayed(sweep_field)(
+            files, df[df.field_name == field], crops_folder, calibrate,
+            crop_transforms, cube_folder, n_jobs, archive, tiled)
+        for field, files in field_files.items())
+    for ix, (field, ids, checksums) in enumerate(results):
+        manifest.add(ids, checksums)
+        manifest.log_field(field, len(ids))
+        print('{} min. {}/{} cropped {} objects in {}'.format(
+            int((time() - start) / 60), ix + 1, len(field_files), len(ids), field))
 
-    data = fits.getdata(files[0])
-    s0, s1 = data.shape
-    arr = np.zeros((s0, s1, n_channels), dtype=np.float32)
-    print('field array shape ', arr.shape)
 
-    prev = files[0].split('/')[-1].split('_')[0]
-    if calibrate:
-        zps = get_zps(prev)
-        data = make_calibration(data, zps[bands[0]])
-    arr[:, :, bands_order[0]] = np.copy(data)
+def get_shard_stats(source, shard, n_channels=12, n_samples=0):
+    """
+    returns the RunningStats of one shard of a crop source
+    receives:
+        * source    (str or CropArchive) crop archive, or None for .npy files
+        * shard     (tuple or list) (archive shard name, offsets of its live
+                    records), see CropArchive.live_offsets, or list of .npy files
+    """
+    stats = RunningStats(n_channels, n_samples)
+    if isinstance(source, str):
+        source = CropArchive(source)
+    if source is not None:
+        stats.update(source.read_live_shard(*shard)[1])
+    else:
+        for file in shard:
+            stats.update(np.load(file))
+    return stats
+
 
+def get_band_stats(filefolder, n_channels=12, n_jobs=8, n_samples=0):
+    """
+    computes per-band statistics over all images in a single pass, sharded
+    across n_jobs processes whose partial results are merged
+    receives:
+        * filefolder    (str or CropArchive) folder pattern wherein ndarray
+                        images are, or a crop archive
+        * n_channels    (int) number of channels in images
+        * n_jobs        (int) number of worker processes
+        * n_samples     (int) number of pixels sampled for quantiles
+    returns:
+        a RunningStats with per-band n, min, max, mean, var and quantiles,
+        which can be merged with the stats of other fields or releases
+    """
     start = time()
-    i = 1
-    lst_ix = len(files[1:]) - 1
-    for ix, f in enumerate(files[1:]):
-        field_name = f.split('/')[-1].split('_')[0]
-        if prev != field_name or ix == lst_ix:
-            print('{} min. cropping objects in {}'.format(
-                int((time() - start) / 60), prev))
-            print('min: {}, max: {}'.format(arr.min(), arr.max()))
-            objects_df = df[df.field_name == prev].reset_index()
-            if not os.path.exists(crops_folder + prev):
-                os.makedirs(crops_folder + prev)
-            Parallel(n_jobs=8)(delayed(crop_object_in_field)(
-                ix, arr, objects_df, crops_folder + prev, asinh) for ix in range(
-                objects_df.shape[0]))
-            arr = np.zeros((s0, s1, n_channels), dtype=np.float32)
-            if calibrate:
-                zps = get_zps(field_name)
-            prev = field_name
-            i = 0
-        data = fits.getdata(f)
-        if calibrate:
-            data = make_calibration(data, zps[bands[i]])
-        arr[:, :, bands_order[i]] = np.copy(data)
-        i += 1
+    if isinstance(filefolder, CropArchive):
+        # live offsets are found here, so that workers need not index the archive
+        source = filefolder.folder
+        shards = [(shard, filefolder.live_offsets(shard)) for shard in filefolder.shards()]
+    else:
+        files = glob(filefolder)
+        n_shards = min(len(files), 16 * n_jobs)
+        source, shards = None, [files[i::n_shards] for i in range(n_shards)]
+    partials = Parallel(n_jobs=n_jobs)(delayed(get_shard_stats)(
+        source, shard, n_channels, n_samples) for shard in shards)
+    stats = RunningStats(n_channels, n_samples)
+    for partial in partials:
+        stats.merge(partial)
+    print('nr of pixels', stats.n)
+    print('minutes taken:', int((time() - start) / 60))
+    return stats
 
 
-def get_min_max(filefolder, n_channels=12):
+def get_min_max(filefolder, n_channels=12, n_jobs=8):
     """
         receives:
-            * filefolder    (str) folder pattern wherein ndarray images are
+            * filefolder    (str or CropArchive) folder pattern wherein
+                            ndarray images are, or a crop archive
             * n_channels    (int) number of channels in images
+            * n_jobs        (int) number of worker processes
         returns:
             a tuple (minima, maxima), each an array of length=n_channels
                     containing minima and maxima per band across all images
     """
-    start = time()
-    files = glob(filefolder)
-    minima, maxima = np.zeros(n_channels), np.zeros(n_channels)
-    min_files, max_files = [''] * n_channels, [''] * n_channels
-    n_files = len(files)
-    print('nr of files', n_files)
-    for file in files:
-        im = np.load(file)
-        min_tmp = np.min(im, axis=(0, 1))
-        max_tmp = np.max(im, axis=(0, 1))
-
-        msk = np.less(min_tmp, minima)
-        if msk.any():
-            minima[msk] = min_tmp[msk]
-            min_files = [file if msk[i] else min_files[i] for i in range(n_channels)]
-
-        msk = np.greater(max_tmp, maxima)
-        if msk.any():
-            maxima[msk] = max_tmp[msk]
-            max_files = [file if msk[i] else max_files[i] for i in range(n_channels)]
-
-    print('minutes taken:', int((time() - start) / 60))
-    print('minima', minima)
-    print(min_files)
-    print('maxima', maxima)
-    print(max_files)
+    stats = get_band_stats(filefolder, n_channels, n_jobs)
+    print('minima', stats.min)
+    print('maxima', stats.max)
 
-    return np.floor(minima), np.ceil(maxima)
+    return np.floor(stats.min), np.ceil(stats.max)
 
 
-def get_mean_var(filefolder, n_channels=12):
+def get_mean_var(filefolder, n_channels=12, n_jobs=8):
     """
         receives:
-            * filefolder    (str) folder pattern wherein ndarray images are
+            * filefolder    (str or CropArchive) folder pattern wherein
+                            ndarray images are, or a crop archive
             * n_channels    (int) number of channels in images
+            * n_jobs        (int) number of worker processes
         returns:
             a tuple (mean, var), each an array of length=n_channels
-                    containing mean and variance per band across all images
-        reference:
-            https://www.researchgate.net/post/
-            How_to_combine_standard_deviations_for_three_groups
+                    containing mean and variance per band across all pixels
+                    of all images
     """
-    start = time()
-    files = glob(filefolder)
-    mean, var = np.zeros(n_channels), np.zeros(n_channels)
-    n_files = len(files)
-    print('nr of files', n_files)
-    for file in files:
-        im = np.load(file)
-        mean = mean + np.mean(im, axis=(0, 1))
-        var = var + np.std(im, axis=(0, 1))
+    stats = get_band_stats(filefolder, n_channels, n_jobs)
+    print('means', stats.mean)
+    print('variances', stats.var)
 
-    mean = mean / n_files
-    var = var / n_files
+    return stats.mean, stats.var
 
-    print('minutes taken:', int((time() - start) / 60))
-    print('means', mean)
-    print('variances', var)
 
-    return mean, var
+def set_normalization(archive, bounds_lower, bounds_upper):
+    """
+    stores normalization bounds in the metadata of a crop archive, so that
+    loaders normalize crops on read instead of reading a normalized copy
+    """
+    archive.set_bounds(bounds_lower, bounds_upper)
+    print('bounds saved to', archive.meta_file)
 
 
 def normalize_images(input_folder, output_folder, bounds_lower, bounds_upper):
     """
     saves ndarray images resized to (32,32,n_channels) and normalized to [0,1]
+    prefer set_normalization for crop archives; this materializes a normalized
+    copy, which is written one shard at a time
     receives:
-        * input_folder      (str) folder path wherein are (x,x,n_channels)
-                            ndarray images with varying shapes and value ranges
-        * output_folder     (str) folder wherein normalized images will be saved
+        * input_folder      (str or CropArchive) folder path wherein are
+                            (x,x,n_channels) ndarray images with varying shapes
+                            and value ranges, or a crop archive
+        * output_folder     (str) folder wherein normalized images will be saved;
+                            a CropArchive input is saved as an archive there
         * bounds_lower      (ndarray) (n_channels,) array that gives lower
                             bounds for normalization
         * bounds_upper      (ndarray) (n_channels,) array that gives upper
                             bounds for normalization
     """
-    files = glob(input_folder)
-    print('nr of files', len(files))
-
     interval = bounds_upper - bounds_lower
     interval = interval[None, None, :]
     lower = bounds_lower[None, None, :]
 
     start = time()
+    if isinstance(input_folder, CropArchive):
+        print('nr of files', len(input_folder))
+        output = CropArchive(output_folder, input_folder.shape, input_folder.dtype)
+        for shard, ids, crops in input_folder.iter_shards():
+            crops = normalize_batch(crops, bounds_lower, bounds_upper)
+            if crops.min() < 0 or crops.max() > 1:
+                print('{} out of [0,1] range'.format(shard))
+            output.append(shard, ids, crops)
+        print('minutes taken:', int((time() - start) / 60))
+        return
+
+    files = glob(input_folder)
+    print('nr of files', len(files))
     for file in files:
         im = np.load(file)
         im = im - lower
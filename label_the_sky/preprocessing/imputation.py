@@ -0,0 +1,96 @@
+import numpy as np
+
+
+# central wavelengths (angstroms) of u, f378, f395, f410, f430, g, f515, r,
+# f660, i, f861, z, as in deprecated/spectra/gen_mocks.py
+central_wavelengths = np.array(
+    [3533.35, 3773.12, 3940.71, 4094.93, 4292.15, 4758.49, 5133.15, 6251.89, 6613.86, 7670.63, 8607.25, 8941.44]
+)
+
+
+def get_undetected_mask(X, undetected=(99, -99)):
+    """
+    returns a boolean mask of undetected magnitudes, i.e., NaN or equal to
+    one of the undetected flag values
+    """
+    mask = np.isnan(X)
+    for value in undetected:
+        mask |= X == value
+    return mask
+
+
+def fill_median(X, mask, wavelengths=None):
+    """
+    fills masked magnitudes of each row with the median of its detected ones;
+    rows without detections are left NaN
+    """
+    # only rows with missing magnitudes; sorting puts NaNs last, so the
+    # median of the k detected magnitudes is around position k / 2
+    rows = np.flatnonzero(mask.any(axis=1))
+    S = np.where(mask[rows], np.nan, X[rows])
+    S.sort(axis=1)
+    counts = S.shape[1] - mask[rows].sum(axis=1)
+    ix = np.arange(len(rows))
+    lo = S[ix, np.maximum((counts - 1) // 2, 0)]
+    hi = S[ix, np.maximum(counts // 2, 0)]
+    medians = np.where(counts > 0, (lo + hi) / 2, np.nan)
+    X[rows] = np.where(mask[rows], medians[:, None], X[rows])
+    return X
+
+
+def fill_interpolate(X, mask, wavelengths=central_wavelengths):
+    """
+    fills masked magnitudes of each row by linear interpolation in wavelength
+    between the nearest detected bands on each side, or with the nearest
+    detected band at the ends; rows without detections are left NaN
+    """
+    n_bands = X.shape[1]
+    bands = np.arange(n_bands)
+    # index of the closest detected band at or before/after each band
+    prev = np.maximum.accumulate(np.where(mask, -1, bands), axis=1)
+    next = np.minimum.accumulate(np.where(mask, n_bands, bands)[:, ::-1], axis=1)[:, ::-1]
+    X[mask] = np.nan
+    rows = np.arange(X.shape[0])[:, None]
+    x_prev = X[rows, np.maximum(prev, 0)]
+    x_next = X[rows, np.minimum(next, n_bands - 1)]
+    x_prev = np.where(prev >= 0, x_prev, x_next)
+    x_next = np.where(next < n_bands, x_next, x_prev)
+    l_prev = wavelengths[np.maximum(prev, 0)]
+    l_next = wavelengths[np.minimum(next, n_bands - 1)]
+    span = l_next - l_prev
+    w = np.where(span > 0, (wavelengths - l_prev) / np.where(span > 0, span, 1), 0)
+    filled = x_prev + w * (x_next - x_prev)
+    X[mask] = filled[mask]
+    return X
+
+
+# name -> function(X, mask, wavelengths) that fills X in place where mask is True
+imputers = {
+    'median': fill_median,
+    'interpolate': fill_interpolate,
+}
+
+
+def impute_magnitudes(
+        X, method='median', undetected=(99, -99), wavelengths=central_wavelengths,
+        chunk_size=1000000):
+    """
+    fills undetected magnitudes of a (n_objects, n_bands) matrix
+    receives:
+        * X             (ndarray) magnitudes, bands ordered by wavelength
+        * method        (str) one of imputers
+        * undetected    (tuple) flag values of undetected magnitudes, besides NaN
+        * wavelengths   (ndarray) (n_bands,) central wavelengths of bands
+        * chunk_size    (int) number of rows imputed at once
+    returns:
+        a float copy of X with undetected magnitudes filled
+    """
+    if method not in imputers:
+        raise ValueError('unknown method {}; expected one of {}'.format(method, list(imputers)))
+    X = np.array(X, dtype=np.float64)
+    for i in range(0, len(X), chunk_size):
+        block = X[i:i + chunk_size]
+        mask = get_undetected_mask(block, undetected)
+        if mask.any():
+            imputers[method](block, mask, wavelengths)
+    return X
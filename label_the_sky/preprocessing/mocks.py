@@ -0,0 +1,196 @@
+"""
+adapted from deprecated/spectra/gen_mocks.py, itself adapted from code by
+Carolina Queiroz
+"""
+
+from astropy.io import fits
+from joblib import Parallel, delayed
+import numpy as np
+import os
+import pandas as pd
+from scipy import interpolate
+import sys
+import time
+
+from label_the_sky.preprocessing.catalog import mock_cols
+from label_the_sky.preprocessing.imputation import central_wavelengths
+from label_the_sky.utils import write_table
+
+
+vel_light = 2.99792458 * 10**18  # angstrom/s
+
+# filter curve files, in the order of mag_cols
+filter_names = ['uJAVA', 'F378', 'F395', 'F410', 'F430', 'gSDSS', 'F515', 'rSDSS', 'F660', 'iSDSS', 'F861', 'zSDSS']
+
+# SDSS spectra are sampled on a common grid of log10 wavelengths in steps of
+# 1e-4, so pixel k of the grid is at 10**(k * loglam_step) angstroms
+loglam_step = 1e-4
+
+
+def f_lambda(wavelength, mag_ab):
+    """ convert AB magnitude to fluxes in units of erg/s/cm^2/angstrom """
+    return (vel_light / wavelength**2) * 10**(-0.4 * (mag_ab + 48.6))
+
+
+def read_filter_curves(filters_folder):
+    """
+    returns a list of (wavelengths, transmissions) of filter_names, with
+    wavelengths in angstroms
+    """
+    curves = []
+    for f in filter_names:
+        wavelengths, transmissions = np.loadtxt(os.path.join(filters_folder, f + '.dat'), unpack=True)
+        curves.append((10. * wavelengths, transmissions))  # nanometers in the S-PLUS files
+    return curves
+
+
+def get_filter_grid(curves):
+    """
+    returns the range (k_start, k_end) of loglam grid pixels that covers all
+    filter curves
+    """
+    lower = min(w.min() for w, _ in curves)
+    upper = max(w.max() for w, _ in curves)
+    return int(np.floor(np.log10(lower) / loglam_step)), int(np.ceil(np.log10(upper) / loglam_step)) + 1
+
+
+def get_filter_matrix(curves, wavelengths):
+    """
+    returns the (n_filters, len(wavelengths)) transmissions of filter curves
+    at the given wavelengths: cubic splines of the curves within their
+    wavelength range, and zero outside of it
+    """
+    T = np.zeros((len(curves), len(wavelengths)))
+    for i, (w, t) in enumerate(curves):
+        inside = (wavelengths >= w.min()) & (wavelengths <= w.max())
+        T[i, inside] = interpolate.InterpolatedUnivariateSpline(w, t, k=3)(wavelengths[inside])
+    return T
+
+
+def read_spectrum(file):
+    """
+    returns (loglam, flux) of an SDSS spectrum file, with masked pixels
+    (ivar = 0, such as saturated ones, which would create artificial emission
+    lines) and non-positive fluxes set to 0.0001 times the average flux
+    """
+    data = fits.getdata(file)
+    loglam = np.asarray(data['loglam'], dtype=np.float64)
+    flux = np.array(data['flux'], dtype=np.float64)
+    ivar = np.asarray(data['ivar'])
+    flux[ivar == 0.0] = 0.0001 * np.average(flux)
+    flux[flux <= 0.0] = 0.0001 * np.average(flux)
+    return loglam, flux
+
+
+def convolve_files(files, T, k_start):
+    """
+    integrates spectra files against all filters at once
+    each spectrum is placed on the loglam grid starting at pixel k_start, with
+    a mask of its measured pixels, and the mean flux of its measured pixels
+    weighted by each filter's transmission is a pair of matrix products
+    receives:
+        * files     (list) SDSS spectrum files
+        * T         (ndarray) (n_filters, n_pixels) filter matrix on the grid
+    returns:
+        (len(files), n_filters) fluxes in erg/s/cm^2/angstrom, 0 for filters
+        without measured pixels
+    """
+    n_pixels = T.shape[1]
+    F = np.zeros((len(files), n_pixels))
+    M = np.zeros((len(files), n_pixels))
+    for row, file in enumerate(files):
+        loglam, flux = read_spectrum(file)
+        k = np.round(loglam / loglam_step).astype(np.int64) - k_start
+        inside = (k >= 0) & (k < n_pixels)
+        F[row, k[inside]] = flux[inside]
+        M[row, k[inside]] = 1
+    weights = M @ T.T
+    covered = M @ (T != 0).T > 0
+    fluxes = np.divide(F @ T.T, weights, out=np.zeros_like(weights), where=covered)
+    return fluxes * 10**(-17)
+
+
+def get_corrections(df):
+    """
+    uJAVA and F378 are not fully covered by SDSS spectra, so their fluxes are
+    replaced by corrected SDSS u magnitudes: u is corrected by the median
+    difference between uJAVA and photometric uSDSS per class, and F378 by the
+    median difference between F378 and uJAVA per class
+    returns:
+        a tuple (corr_u, corr_f378) of arrays, one value per row of df
+    """
+    corr_u = (df['u'] - df['modelMag_u']).groupby(df['class']).transform('median').round(4)
+    corr_f378 = (df['f378'] - df['u']).groupby(df['class']).transform('median').round(4)
+    return corr_u.values, corr_f378.values
+
+
+def get_spectrum_filenames(df):
+    return (
+        'spec-' + df['plate'].astype(str).str.zfill(4) + '-' + df['mjd'].astype(str)
+        + '-' + df['fiberID'].astype(str).str.zfill(4))
+
+
+def gen_mocks(df, spectra_folder, filters_folder, output_file=None, n_jobs=8, chunk_size=1000):
+    """
+    computes mock magnitudes of SDSS spectra in the S-PLUS filters
+    filter curves are interpolated once on the common loglam grid, and chunks
+    of chunk_size spectra are integrated in n_jobs processes
+    receives:
+        * df                (DataFrame) objects with SDSS plate, mjd, fiberID,
+                            class and modelMag_u columns, and S-PLUS u and f378
+                            magnitudes for the corrections
+        * spectra_folder    (str) folder wherein are spec-<plate>-<mjd>-<fiber>.fits files
+        * filters_folder    (str) folder wherein are S-PLUS <filter>.dat curves
+        * output_file       (str) optional csv or parquet file to save df to
+    returns:
+        df with a filename column and mock_cols; filters without spectrum
+        coverage are set to 99
+    """
+    start = time.time()
+    df = df.copy()
+    df['filename'] = get_spectrum_filenames(df)
+    if df['filename'].duplicated().any():
+        raise ValueError('spectra are not unique')
+    files = [os.path.join(spectra_folder, f + '.fits') for f in df['filename']]
+    missing = [f for f in files if not os.path.exists(f)]
+    if len(missing) > 0:
+        raise FileNotFoundError('{} spectra not found, e.g., {}'.format(len(missing), missing[0]))
+
+    curves = read_filter_curves(filters_folder)
+    k_start, k_end = get_filter_grid(curves)
+    T = get_filter_matrix(curves, 10**(np.arange(k_start, k_end) * loglam_step))
+
+    print('nr of spectra', len(files))
+    chunks = Parallel(n_jobs=n_jobs)(
+        delayed(convolve_files)(files[i:i + chunk_size], T, k_start)
+        for i in range(0, len(files), chunk_size))
+    f_convol = np.concatenate(chunks) if chunks else np.empty((0, len(filter_names)))
+
+    corr_u, corr_f378 = get_corrections(df)
+    mag_u_splus = df['modelMag_u'].values + corr_u
+    f_convol[:, 0] = f_lambda(central_wavelengths[0], mag_u_splus)
+    f_convol[:, 1] = f_lambda(central_wavelengths[1], mag_u_splus + corr_f378)
+
+    # F_lambda to F_nu, erg/s/cm^2/Hz, then AB magnitudes
+    f_convol_nu = (central_wavelengths**2 / vel_light) * f_convol
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mag_ab = np.round(-2.5 * np.log10(f_convol_nu) - 48.6, 5)
+    mag_ab[~np.isfinite(mag_ab)] = 99
+    df[mock_cols] = mag_ab
+
+    print('minutes taken:', int((time.time() - start) / 60))
+    if output_file is not None:
+        write_table(df, output_file)
+    return df
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5:
+        print('usage: python {} <input_csv> <output_csv> <filter_folder> <spectra_folder>'.format(sys.argv[0]))
+        exit()
+
+    gen_mocks(
+        df=pd.read_csv(sys.argv[1]),
+        spectra_folder=sys.argv[4],
+        filters_folder=sys.argv[3],
+        output_file=sys.argv[2])
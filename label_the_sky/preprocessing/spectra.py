@@ -1,9 +1,14 @@
 from glob import glob
+from itertools import zip_longest
+from joblib import Parallel, delayed
 import pandas as pd
 import numpy as np
 import os
 import time
 
+from label_the_sky.preprocessing.archive import SpectrumStore
+from label_the_sky.preprocessing.stats import RunningStats, normalize_batch
+
 
 sparse_thres = 0.3
 lamb_lower = 3750
@@ -33,62 +38,133 @@ def get_unique_lambs(unique_loglambs_filepath, loglambs_filepath):
     return lambs
 
 
-def to_angstrom(loglamb):
-    lamb = np.round(10**loglamb).astype(int)
-    lamb = lamb[(lamb>=lamb_lower) & (lamb<=lamb_upper)]
-    lamb, unique_idx = np.unique(lamb, return_index=True)
-    if lamb[0] == 1:
-        lamb = lamb[1:]
-        unique_idx = unique_idx[1:]
-    return lamb, unique_idx
-
-
-def gen_series(flux_arr, lamb_arr, base_series):
-    series = pd.Series(data=flux_arr, index=lamb_arr)
-    series = series.combine_first(base_series)
-    series.interpolate(method='spline', order=1, limit_direction='both', inplace=True)
-    return series
-
+def resample_spectra(loglambs, fluxes):
+    '''
+    resamples a block of spectra onto the integer wavelength grid lambs_interval
+    wavelengths are rounded to integer angstroms, keeping the first pixel of
+    each, and fluxes in between are interpolated linearly; beyond the first
+    and last measured wavelengths, fluxes are held constant
+        receives:
+            * loglambs      (ndarray) (n_spectra, n_pixels) log10 wavelengths,
+                            zero-padded
+            * fluxes        (ndarray) (n_spectra, n_pixels) fluxes
+        returns:
+            a tuple (resampled, coverage) of the (n_spectra, len(lambs_interval))
+            resampled fluxes and the number of distinct wavelengths within
+            [lamb_lower, lamb_upper] of each spectrum
+    '''
+    n = loglambs.shape[0]
+    width = lamb_upper - lamb_lower + 1
+    lamb = np.round(10**np.asarray(loglambs, dtype=np.float64)).astype(np.int64)
+    rows, cols = np.nonzero((lamb >= lamb_lower) & (lamb <= lamb_upper))
+
+    # positions in the (n, width) grid; np.unique keeps the first pixel of each
+    keys = rows * width + lamb[rows, cols] - lamb_lower
+    keys, first = np.unique(keys, return_index=True)
+    grid = np.full(n * width, np.nan)
+    grid[keys] = np.asarray(fluxes)[rows[first], cols[first]]
+    grid = grid.reshape(n, width)
+    coverage = np.bincount(keys // width, minlength=n)
+
+    # closest measured wavelength at or before/after each grid wavelength
+    known = ~np.isnan(grid)
+    pos = np.arange(width)
+    prev = np.maximum.accumulate(np.where(known, pos, -1), axis=1)
+    next = np.minimum.accumulate(np.where(known, pos, width)[:, ::-1], axis=1)[:, ::-1]
+    prev = np.where(prev >= 0, prev, next)
+    next = np.where(next < width, next, prev)
+    r = np.arange(n)[:, None]
+    f_prev = grid[r, np.minimum(prev, width - 1)]
+    f_next = grid[r, np.minimum(next, width - 1)]
+    span = next - prev
+    w = np.where(span > 0, (pos - prev) / np.maximum(span, 1), 0)
+    resampled = f_prev + w * (f_next - f_prev)
+    return resampled[:, :len(lambs_interval)], coverage
+
+
+def save_resampled(object_ids, resampled, output, valid, shard='spectra'):
+    '''
+    saves valid resampled spectra as txt files in output, or appends all of
+    them with their validity to output when it is a SpectrumStore
+    '''
+    if isinstance(output, SpectrumStore):
+        output.append(shard, list(object_ids), resampled, valid)
+        return
+    for object_id, flux in zip(object_ids[valid], resampled[valid]):
+        np.savetxt('{}{}.txt'.format(output, object_id), flux)
 
-def preprocess_matrices(loglambs_filepath, fluxes_filepath, objects_filepath):
-    start = time.perf_counter()
-    print('loading loglamb matrix')
-    lambs = pd.read_csv(loglambs_filepath,sep=' ', header=None)
-    lambs = lambs.values
-    print('time taken (min)', (time.perf_counter()-start)/60)
 
-    base_series = pd.Series(index=lambs_interval)
+def iter_matrix_blocks(loglambs_filepath, fluxes_filepath, objects_filepath, block_size=1000):
+    '''
+    streams the loglamb and flux matrix files and the objects file in
+    lockstep, so that only block_size rows of each are in memory at a time
+    yields:
+        tuples (object_ids, loglambs, fluxes) of aligned rows
+    '''
+    lambs_reader = pd.read_csv(loglambs_filepath, sep=' ', header=None, chunksize=block_size)
+    fluxes_reader = pd.read_csv(fluxes_filepath, sep=' ', header=None, chunksize=block_size)
+    objects_reader = pd.read_csv(objects_filepath, header=None, chunksize=block_size)
+    for lambs, fluxes, objects in zip_longest(lambs_reader, fluxes_reader, objects_reader):
+        if lambs is None or fluxes is None or objects is None or not len(lambs) == len(fluxes) == len(objects):
+            raise ValueError('{}, {} and {} have different numbers of rows'.format(
+                loglambs_filepath, fluxes_filepath, objects_filepath))
+        yield objects[1].values, lambs.values, fluxes.values
 
-    object_idx = pd.read_csv(objects_filepath, header=None)
-    object_idx = object_idx[1].values
 
-    print('loading flux matrix')
-    fluxes = pd.read_csv(fluxes_filepath, sep=' ', header=None)
-    fluxes = fluxes.values
-    print('time taken (min)', (time.perf_counter()-start)/60)
+def resample_block(object_ids, lambs, fluxes):
+    '''
+    resamples a block of matrix rows
+    returns:
+        a tuple (object_ids, resampled, valid), wherein zero-padded rows and
+        rows with less than sparse_thres of their pixels in range are invalid
+    '''
+    resampled, coverage = resample_spectra(lambs, fluxes)
+    zero = lambs[:, 0] == 0
+    sparse = coverage / fluxes.shape[1] < sparse_thres
+    print('skip: {} zero arrays, {} sparse series.'.format(zero.sum(), (sparse & ~zero).sum()))
+    return object_ids, resampled, ~zero & ~sparse
 
-    n, total_length = fluxes.shape
 
-    for i in range(n):
-        print('processing', object_idx[i])
-        if lambs[i,0] == 0:
-            print('skip: zero array.')
-            continue
-        lamb, unique_idx = to_angstrom(lambs[i])
-        if len(unique_idx)/total_length < sparse_thres:
-            print('skip: sparse series.')
-            continue
-        series = gen_series(fluxes[i, unique_idx], lamb, base_series)
-        np.savetxt('spectra/flux-processed/{}.txt'.format(object_idx[i]), series.values)
+def preprocess_matrices(
+        loglambs_filepath, fluxes_filepath, objects_filepath,
+        output='spectra/flux-processed/', block_size=1000, n_jobs=1):
+    '''
+    resamples the spectra in the rows of loglamb and flux matrix files
+    the files are streamed in blocks of block_size rows, so memory is bounded
+    by about 2 * n_jobs blocks whatever the size of the matrices
+    receives:
+        * output        (str or SpectrumStore) folder wherein a txt file per
+                        spectrum is saved, or a spectrum store wherein every
+                        row is appended, in matrix order, with its validity
+        * n_jobs        (int) number of processes that resample blocks
+    '''
+    start = time.perf_counter()
+    blocks = iter_matrix_blocks(loglambs_filepath, fluxes_filepath, objects_filepath, block_size)
+    if n_jobs == 1:
+        results = (resample_block(*block) for block in blocks)
+    else:
+        results = Parallel(n_jobs=n_jobs, return_as='generator')(
+            delayed(resample_block)(*block) for block in blocks)
+
+    n = 0
+    for object_ids, resampled, valid in results:
+        save_resampled(object_ids, resampled, output, valid)
+        n += len(object_ids)
+        print('processed {}, time taken (min)'.format(n), (time.perf_counter()-start)/60)
 
     print('time taken (min)', (time.perf_counter()-start)/60)
 
 
-def preprocess_files(loglambs_folder, fluxes_folder):
+def preprocess_files(
+        loglambs_folder, fluxes_folder, output='spectra/flux-processed/',
+        block_size=1000):
+    '''
+    resamples the spectra in pairs of loglamb and flux txt files
+    receives:
+        * output        (str or SpectrumStore) see preprocess_matrices
+    '''
     start = time.perf_counter()
 
-    base_series = pd.Series(index=lambs_interval)
-
     total_length = len(lambs_interval)
     print('sequence length', total_length)
 
@@ -99,81 +175,168 @@ def preprocess_files(loglambs_folder, fluxes_folder):
 
     print('nr of spectra to process', len(flux_files))
 
-    for ix, file in enumerate(flux_files):
-        object_id = file.split('/')[-1][:-4]
-        print('processing', file)
-        flux = np.loadtxt(file)
-        lamb = np.loadtxt(loglamb_files[ix])
-        lamb, unique_idx = to_angstrom(lamb)
+    for i in range(0, len(flux_files), block_size):
+        files = flux_files[i:i+block_size]
+        object_ids = np.array([file.split('/')[-1][:-4] for file in files])
+        fluxes = [np.atleast_1d(np.loadtxt(file)) for file in files]
+        lambs = [np.atleast_1d(np.loadtxt(file)) for file in loglamb_files[i:i+block_size]]
+
+        # zero-padded to the longest spectrum of the block
+        n_pixels = max(len(f) for f in fluxes)
+        flux_block = np.zeros((len(files), n_pixels))
+        lamb_block = np.zeros((len(files), n_pixels))
+        for j in range(len(files)):
+            flux_block[j, :len(fluxes[j])] = fluxes[j]
+            lamb_block[j, :len(lambs[j])] = lambs[j]
+
+        resampled, coverage = resample_spectra(lamb_block, flux_block)
+        sparse = coverage / total_length < sparse_thres
+        if sparse.any():
+            print('skip: {} sparse sequences.'.format(sparse.sum()))
+        save_resampled(object_ids, resampled, output, ~sparse)
+
+        print('processed {}/{}, time taken (min)'.format(i + len(files), len(flux_files)),
+              (time.perf_counter()-start)/60)
+
+    print('time taken (min)', (time.perf_counter()-start)/60)
 
-        if len(lamb)/total_length < sparse_thres:
-            print('skip: sparse sequence.')
-            continue
 
-        series = gen_series(flux[unique_idx], lamb, base_series)
-        assert len(series)==len(base_series)
-        np.savetxt('spectra/flux-processed/{}.txt'.format(object_id), series.values)
+def get_shard_stats(source, shard, n_samples=0):
+    '''
+    returns the per-wavelength RunningStats of one shard of spectra
+    receives:
+        * source    (str or SpectrumStore) spectrum store, or None for txt files
+        * shard     (tuple or list) (store shard, offsets) of records, see
+                    get_store_chunks, or list of txt files
+    '''
+    stats = RunningStats(len(lambs_interval), n_samples)
+    if isinstance(source, str):
+        source = SpectrumStore(source)
+    if source is not None:
+        name, offsets = shard
+        stats.update(source.read_shard(name)[offsets])
+    else:
+        for file in shard:
+            stats.update(np.loadtxt(file))
+    return stats
+
+
+def get_store_chunks(store, n_chunks):
+    '''
+    returns (shard, offsets) chunks that split the live and valid records of
+    a spectrum store into about n_chunks parts; records of ids that were
+    appended again are left out, see CropArchive.live_offsets
+    '''
+    offsets = {}
+    for shard in store.shards():
+        live = store.live_offsets(shard)
+        offsets[shard] = live[store.read_valid(shard)[live]]
+    step = max(1, int(np.ceil(sum(len(o) for o in offsets.values()) / n_chunks)))
+    return [(shard, o[i:i + step]) for shard, o in offsets.items() for i in range(0, len(o), step)]
 
-        if ix % 5000 == 0:
-            print('time taken (min)', (time.perf_counter()-start)/60)           
 
-    print('time taken (min)', (time.perf_counter()-start)/60)
+def get_spectra_stats(filefolder, n_jobs=8, n_samples=0):
+    '''
+    computes per-wavelength statistics over all spectra in a single pass,
+    sharded across n_jobs processes whose partial results are merged
+    receives:
+        * filefolder    (str or SpectrumStore) folder pattern wherein txt
+                        spectra are, or a spectrum store
+        * n_jobs        (int) number of worker processes
+        * n_samples     (int) number of spectra sampled for quantiles
+    returns:
+        a RunningStats with n, min, max, mean, var and quantiles per
+        wavelength of lambs_interval; use its pooled() for global statistics
+    '''
+    start = time.perf_counter()
+    if isinstance(filefolder, SpectrumStore):
+        source, shards = filefolder.folder, get_store_chunks(filefolder, 16 * n_jobs)
+    else:
+        files = glob(filefolder)
+        n_shards = min(len(files), 16 * n_jobs)
+        source, shards = None, [files[i::n_shards] for i in range(n_shards)]
+    partials = Parallel(n_jobs=n_jobs)(delayed(get_shard_stats)(
+        source, shard, n_samples) for shard in shards)
+    stats = RunningStats(len(lambs_interval), n_samples)
+    for partial in partials:
+        stats.merge(partial)
+    print('nr of spectra', stats.n)
+    print('minutes taken:', int((time.perf_counter()-start)/60))
+    return stats
 
 
-def get_min_max(filefolder):
+def get_min_max(filefolder, n_jobs=8):
     '''
         receives:
-            * filefolder    (str) folder pattern wherein txt spectra are
+            * filefolder    (str or SpectrumStore) folder pattern wherein txt
+                            spectra are, or a spectrum store
+            * n_jobs        (int) number of worker processes
         returns:
-            a tuple (minimum, maximum) 
+            a tuple (minimum, maximum) across all wavelengths of all spectra
     '''
-    start = time.perf_counter()
-    files = glob(filefolder)
-    minimum, maximum = 1000, 0
-    min_file, max_file = '', ''
-    n_files = len(files)
-    print('nr of files', n_files)
-    for file in files:
-        spectra = np.loadtxt(file)
-        min_tmp = np.min(spectra)
-        max_tmp =  np.max(spectra)
+    stats = get_spectra_stats(filefolder, n_jobs).pooled()
+    print('minimum :', stats.min[0])
+    print('maximum :', stats.max[0])
 
-        if min_tmp < minimum:
-            minimum = min_tmp
-            min_file = file
+    return np.floor(stats.min[0]), np.ceil(stats.max[0])
 
-        if max_tmp > maximum:
-            maximum = max_tmp
-            max_file = file
 
-    print('minutes taken:', int((time.perf_counter()-start)/60))
-    print('minimum : {} at {}'.format(minimum, min_file))
-    print('maximum : {} at {}'.format(maximum, max_file))
+def set_normalization(store, bound_lower, bound_upper):
+    '''
+    stores normalization bounds in the metadata of a spectrum store, so that
+    spectra are normalized on read (store.read(ids, normalize=True)); bounds
+    are floats, or (len(lambs_interval),) arrays for per-wavelength bounds
+    '''
+    store.set_bounds(np.atleast_1d(bound_lower), np.atleast_1d(bound_upper))
+    print('bounds saved to', store.meta_file)
 
-    return np.floor(minimum), np.ceil(maximum)
 
+def normalize_files(files, output_folder, bound_lower, bound_upper):
+    interval = np.subtract(bound_upper, bound_lower)
+    for file in files:
+        spectra = (np.loadtxt(file) - bound_lower) / interval
+        if spectra.min() < 0 or spectra.max() > 1:
+            print('{} out of [0,1] range'.format(file.split('/')[-1]))
+        np.savetxt('{}{}'.format(output_folder, file.split('/')[-1]), spectra)
 
-def normalize(input_folder, output_folder, bound_lower, bound_upper):
+
+def normalize(input_folder, output_folder, bound_lower, bound_upper, n_jobs=8, block_size=10000):
     '''
     saves spectra normalized to values in [0,1]
+    prefer set_normalization for spectrum stores; this materializes a
+    normalized copy
     receives:
-        * input_folder      (str) folder path wherein are 1-d arrays in txt files with varying ranges
-        * output_folder     (str) folder wherein normalized txt will be saved
-        * bounds_lower      (float) lower bound for normalization
-        * bounds_upper      (float) upper bound for normalization 
+        * input_folder      (str or SpectrumStore) folder path wherein are 1-d
+                            arrays in txt files with varying ranges, or a
+                            spectrum store
+        * output_folder     (str) folder wherein normalized txt will be saved;
+                            a SpectrumStore input is saved as a store there,
+                            block_size records at a time
+        * bound_lower       (float or ndarray) lower bound for normalization
+        * bound_upper       (float or ndarray) upper bound for normalization
+        * n_jobs            (int) number of worker processes for txt files
     '''
+    start = time.perf_counter()
+    if isinstance(input_folder, SpectrumStore):
+        print('nr of spectra', len(input_folder))
+        output = SpectrumStore(output_folder, len(lambs_interval))
+        for shard in input_folder.shards():
+            offsets = input_folder.live_offsets(shard)
+            ids = [input_folder.shard_ids(shard)[o] for o in offsets]
+            spectra = input_folder.read_shard(shard)
+            valid = input_folder.read_valid(shard)[offsets]
+            for i in range(0, len(ids), block_size):
+                block = normalize_batch(spectra[offsets[i:i+block_size]], bound_lower, bound_upper)
+                checked = block[valid[i:i+block_size]]
+                if len(checked) > 0 and (checked.min() < 0 or checked.max() > 1):
+                    print('{} out of [0,1] range'.format(shard))
+                output.append(shard, ids[i:i+block_size], block, valid[i:i+block_size])
+        print('minutes taken:', int((time.perf_counter()-start)/60))
+        return
+
     files = glob(input_folder)
     print('nr of files', len(files))
-
-    interval = bound_upper - bound_lower
-    lower = bound_lower
-
-    start = time()
-    for file in files:
-        spectra = np.loadtxt(file)
-        spectra = spectra - lower
-        spectra = spectra / interval
-        if spectra.min() < 0 or spectra.max() > 1:
-            print('{} out of [0,1] range'.format(file.split('/')[-1]))
-        np.savetxt('{}{}'.format(output_folder, file.split('/')[-1]), spectra)
-    print('minutes taken:', int((time()-start)/60))
+    n_shards = min(len(files), 16 * n_jobs)
+    Parallel(n_jobs=n_jobs)(delayed(normalize_files)(
+        files[i::n_shards], output_folder, bound_lower, bound_upper) for i in range(n_shards))
+    print('minutes taken:', int((time.perf_counter()-start)/60))
@@ -0,0 +1,136 @@
+import numpy as np
+import os
+import pandas as pd
+
+from label_the_sky.utils import read_table, write_table
+
+
+split_names = ['train', 'val', 'test']
+
+# (class, r magnitude bin) strata too small to split, merged into a neighbour
+stratum_merges = {
+    ('QSO', 14): 18, ('QSO', 16): 18,
+    ('GALAXY', 14): 16, ('STAR', 14): 16,
+    ('GALAXY', 24): 23, ('GALAXY', 20): 19, ('STAR', 23): 22,
+}
+
+max_mag_bin = 64
+
+
+def get_labeled_strata(classes, r):
+    """
+    returns integer strata codes class * max_mag_bin + mag_bin of labeled
+    objects, wherein mag_bin is r rounded within [14, 21] (QSO rounded up to
+    an even bin), with small strata merged as in stratum_merges
+    receives:
+        * classes   (ndarray) class names
+        * r         (ndarray) r magnitudes
+    returns:
+        a tuple (strata, labels) of codes and a dict mapping codes to
+        names like GALAXY19
+    """
+    class_names, class_codes = np.unique(np.asarray(classes), return_inverse=True)
+    mag_bin = np.round(np.clip(r, 14, 21)).astype(np.int64)
+    qso = np.flatnonzero(class_names == 'QSO')
+    if len(qso) > 0:
+        is_qso = class_codes == qso[0]
+        mag_bin[is_qso] += mag_bin[is_qso] % 2
+
+    lookup = np.tile(np.arange(max_mag_bin), (len(class_names), 1))
+    for (class_name, mag), merged_mag in stratum_merges.items():
+        code = np.flatnonzero(class_names == class_name)
+        if len(code) > 0:
+            lookup[code[0], mag] = merged_mag
+    strata = class_codes * max_mag_bin + lookup[class_codes, mag_bin]
+
+    labels = {
+        s: '{}{}'.format(class_names[s // max_mag_bin], s % max_mag_bin)
+        for s in np.unique(strata)}
+    return strata, labels
+
+
+def get_unlabeled_strata(r):
+    """
+    returns the r magnitude bins of unlabeled objects: r, or r + 1 unless r
+    is even, truncated
+    """
+    r = np.asarray(r)
+    return np.where(r % 2 == 0, r, r + 1).astype(np.uint8)
+
+
+def get_id_uniforms(ids, hash_key='0123456789123456'):
+    """
+    returns a deterministic number in [0, 1) per object id, which depends only
+    on the id itself and on hash_key (16 characters)
+    """
+    h = pd.util.hash_pandas_object(pd.Series(ids), index=False, hash_key=hash_key).values
+    return (h >> np.uint64(11)).astype(np.float64) / 2**53
+
+
+def assign_splits(ids, strata, test_size=0.05, val_size=0.05, exact=True, hash_key='0123456789123456'):
+    """
+    assigns objects to train (0), val (1) and test (2) in a single pass
+    by default (exact), objects are ranked by id hash within each stratum and
+    the first round(n * test_size) of each stratum go to test, and then
+    round((n - n_test) * val_size) go to val, so every stratum is split with
+    exact proportions; boundaries move as strata grow, so use a split_file
+    to keep known objects in their split.
+    otherwise, an object is in test when its id hash is below test_size and
+    in val when it is below test_size + val_size * (1 - test_size); strata
+    are then ignored, and assignments depend only on ids, but small strata
+    may have no val or test objects
+    returns:
+        (n,) uint8 array of split codes, see split_names
+    """
+    u = get_id_uniforms(ids, hash_key)
+    test_end = test_size
+    val_end = test_size + val_size * (1 - test_size)
+    if exact:
+        strata = np.asarray(strata)
+        order = np.lexsort((u, strata))
+        _, starts, counts = np.unique(strata[order], return_index=True, return_counts=True)
+        ranks = np.empty(len(u))
+        ranks[order] = np.arange(len(u)) - np.repeat(starts, counts)
+        n = np.repeat(counts, counts)[np.argsort(order)]
+        # ranks are compared to the split boundaries of each stratum
+        u = ranks
+        test_end = np.round(n * test_size)
+        val_end = test_end + np.round((n - test_end) * val_size)
+    splits = np.zeros(len(u), dtype=np.uint8)
+    splits[u < val_end] = 1
+    splits[u < test_end] = 2
+    return splits
+
+
+def get_split_column(splits):
+    """
+    returns split codes as a categorical column of split_names
+    """
+    return pd.Categorical.from_codes(splits, split_names)
+
+
+def apply_saved_splits(ids, splits, split_file):
+    """
+    keeps the splits saved in split_file for known ids, and saves the split
+    of new ids to it, as a compact (id, split) table
+    returns:
+        split codes with saved assignments applied
+    """
+    ids = pd.Series(ids)
+    saved = None
+    if os.path.exists(split_file):
+        saved = read_table(split_file)
+        saved_codes = pd.Categorical(saved['split'], categories=split_names).codes
+        codes = pd.Series(saved_codes, index=saved['id'].values)
+        known = ids.isin(codes.index).values
+        splits = splits.copy()
+        splits[known] = codes.loc[ids[known]].values
+        new = ~known
+    else:
+        new = np.ones(len(ids), dtype=bool)
+    if new.any():
+        new_rows = pd.DataFrame({'id': ids[new].values, 'split': get_split_column(splits[new])})
+        table = new_rows if saved is None else pd.concat([saved, new_rows], ignore_index=True)
+        table['split'] = pd.Categorical(table['split'], categories=split_names)
+        write_table(table, split_file)
+    return splits
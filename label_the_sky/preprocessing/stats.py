@@ -0,0 +1,117 @@
+import numpy as np
+
+
+def normalize_batch(X, bounds_lower, bounds_upper):
+    """
+    maps X to [0,1] per channel (last axis) in a single fused pass,
+    in place when X is already a writeable float32 array
+    receives:
+        * X             (ndarray) (..., n_channels) batch
+        * bounds_lower  (ndarray) (n_channels,) lower bounds for normalization
+        * bounds_upper  (ndarray) (n_channels,) upper bounds for normalization
+    returns:
+        the normalized float32 batch
+    """
+    X = np.asarray(X, dtype=np.float32)
+    if not X.flags.writeable:
+        X = X.copy()
+    lower = np.asarray(bounds_lower, dtype=np.float32)
+    scale = 1 / (np.asarray(bounds_upper, dtype=np.float32) - lower)
+    np.subtract(X, lower, out=X)
+    np.multiply(X, scale, out=X)
+    return X
+
+
+class RunningStats:
+    """
+    streaming per-feature statistics: count, minimum, maximum, mean and
+    variance, plus an optional random sample of rows for quantiles
+    partial results computed over separate shards (e.g. in separate processes)
+    are combined exactly with merge
+    reference:
+        Chan, Golub & LeVeque, "Updating formulae and a pairwise algorithm for
+        computing sample variances", 1979
+    """
+
+    def __init__(self, n_features, n_samples=0, seed=0):
+        self.n_features = n_features
+        self.n = 0
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+        self.min = np.full(n_features, np.inf)
+        self.max = np.full(n_features, -np.inf)
+        self.n_samples = n_samples
+        self.samples = np.empty((0, n_features))
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def var(self):
+        return self.m2 / np.maximum(self.n, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def update(self, block):
+        """
+        adds a block of shape (..., n_features) to the statistics
+        """
+        block = np.asarray(block).reshape(-1, self.n_features)
+        if len(block) == 0:
+            return self
+        other = RunningStats(self.n_features, self.n_samples)
+        other.n = len(block)
+        other.mean = block.mean(axis=0, dtype=np.float64)
+        other.m2 = np.square(block - other.mean).sum(axis=0, dtype=np.float64)
+        other.min = block.min(axis=0).astype(np.float64)
+        other.max = block.max(axis=0).astype(np.float64)
+        if self.n_samples > 0:
+            idx = self.rng.choice(len(block), min(len(block), self.n_samples), replace=False)
+            other.samples = block[idx].astype(np.float64)
+        return self.merge(other)
+
+    def merge(self, other):
+        """
+        combines the statistics of other into self
+        """
+        n = self.n + other.n
+        if other.n == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + np.square(delta) * self.n * other.n / n
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        if self.n_samples > 0:
+            # keep each side's share of the sample proportional to its count
+            k_self = min(len(self.samples), int(round(self.n_samples * self.n / n)))
+            k_other = min(len(other.samples), self.n_samples - k_self)
+            self.samples = np.concatenate([
+                self.samples[self.rng.permutation(len(self.samples))[:k_self]],
+                other.samples[self.rng.permutation(len(other.samples))[:k_other]]])
+        self.n = n
+        return self
+
+    def pooled(self):
+        """
+        returns the statistics of all features taken together, as a
+        RunningStats of a single feature; samples are not pooled
+        """
+        pooled = RunningStats(1)
+        if self.n == 0:
+            return pooled
+        pooled.n = self.n * self.n_features
+        pooled.mean = np.array([self.mean.mean()])
+        pooled.m2 = np.array([self.m2.sum() + self.n * np.square(self.mean - pooled.mean).sum()])
+        pooled.min = np.array([self.min.min()])
+        pooled.max = np.array([self.max.max()])
+        return pooled
+
+    def quantiles(self, q):
+        """
+        returns approximate per-feature quantiles q (in [0, 1]) from the
+        sampled rows, as an array of shape (len(q), n_features)
+        """
+        if len(self.samples) == 0:
+            raise ValueError('no samples kept; set n_samples > 0')
+        return np.quantile(self.samples, q, axis=0)
@@ -0,0 +1,140 @@
+import numpy as np
+
+
+PIXEL_SCALE = 0.55  # arcsec / pixel
+
+
+def get_calibration_scale(zp, ps=PIXEL_SCALE):
+    """
+    returns the factor that maps counts to surface brightness
+    [1e5 erg / (s cm^2 Hz arcsec^2)], i.e., make_calibration(data, zp) / data
+    receives:
+        * zp    (float or ndarray) zero point(s), e.g., one per band of a field
+    """
+    return 1e5 * np.power(10, -0.4 * np.asarray(zp, dtype=np.float64)) / ps**2
+
+
+def calibrate(zps):
+    return [('affine', get_calibration_scale(zps), 0)]
+
+
+def affine(scale=1, offset=0):
+    return [('affine', scale, offset)]
+
+
+def asinh(a=0.1):
+    # same as astropy's AsinhStretch(a)(X, clip=False)
+    return [('affine', 1 / a, 0), ('ufunc', np.arcsinh), ('affine', 1 / np.arcsinh(1 / a), 0)]
+
+
+def clip(lower=0, upper=1):
+    return [('clip', lower, upper)]
+
+
+def normalize(bounds_lower, bounds_upper):
+    scale = 1 / (np.asarray(bounds_upper, dtype=np.float64) - bounds_lower)
+    return [('affine', scale, -np.asarray(bounds_lower, dtype=np.float64) * scale)]
+
+
+# name -> function that receives the parameters of a step and returns its
+# primitive operations: ('affine', scale, offset), ('ufunc', f), ('clip', lower, upper)
+TRANSFORMS = {
+    'calibrate': calibrate,
+    'affine': affine,
+    'asinh': asinh,
+    'clip': clip,
+    'normalize': normalize,
+}
+
+# parameters that are bound per field and are not part of a chain description
+FIELD_PARAMS = ['zps']
+
+
+def get_step(step):
+    """
+    returns (name, params) of a step given as a name or a (name, params) tuple
+    """
+    if isinstance(step, str):
+        return step, {}
+    name, params = step
+    return name, dict(params)
+
+
+def compile_transforms(steps):
+    """
+    turns a chain of steps into primitive operations, folding consecutive
+    affine operations into a single per-channel multiply-add
+    receives:
+        * steps     (list) transform steps, each a name in TRANSFORMS or a
+                    (name, params) tuple, e.g.,
+                    ['asinh', ('clip', {'lower': 0, 'upper': 1})]
+    returns:
+        list of primitive operations to be run by apply_transforms
+    """
+    ops = []
+    for step in steps:
+        name, params = get_step(step)
+        if name not in TRANSFORMS:
+            raise ValueError('unknown transform {}; expected one of {}'.format(
+                name, list(TRANSFORMS)))
+        for op in TRANSFORMS[name](**params):
+            if op[0] == 'affine' and len(ops) > 0 and ops[-1][0] == 'affine':
+                _, scale, offset = ops.pop()
+                op = ('affine', np.multiply(scale, op[1]), np.multiply(offset, op[1]) + op[2])
+            ops.append(op)
+    compiled = []
+    for op in ops:
+        if op[0] == 'affine':
+            scale = np.asarray(op[1], dtype=np.float32)
+            offset = np.asarray(op[2], dtype=np.float32)
+            op = ('affine', None if np.all(scale == 1) else scale,
+                  None if np.all(offset == 0) else offset)
+        compiled.append(op)
+    return compiled
+
+
+def apply_transforms(X, ops):
+    """
+    applies a chain of transforms to X (..., n_channels) in place, in a
+    single float32 pass per primitive operation and without temporaries
+    receives:
+        * X             (ndarray) batch of crops or a field region
+        * ops           (list) operations returned by compile_transforms
+    returns:
+        the transformed float32 array; X itself when it is a writeable
+        float32 array
+    """
+    X = np.asarray(X, dtype=np.float32)
+    if not X.flags.writeable:
+        X = X.copy()
+    for op in ops:
+        if op[0] == 'affine':
+            if op[1] is not None:
+                np.multiply(X, op[1], out=X)
+            if op[2] is not None:
+                np.add(X, op[2], out=X)
+        elif op[0] == 'ufunc':
+            op[1](X, out=X)
+        elif op[0] == 'clip':
+            np.clip(X, op[1], op[2], out=X)
+    return X
+
+
+def describe_transforms(steps):
+    """
+    returns a string that identifies a chain of steps, e.g.,
+    calibrate>asinh>clip(lower=0;upper=1), to be recorded with crops
+    """
+    descriptions = []
+    for step in steps:
+        name, params = get_step(step)
+        values = []
+        for k in sorted(params):
+            if k in FIELD_PARAMS:
+                continue
+            v = params[k]
+            if np.ndim(v) > 0:
+                v = ' '.join('{:g}'.format(e) for e in np.ravel(v))
+            values.append('{}={}'.format(k, v))
+        descriptions.append('{}({})'.format(name, ';'.join(values)) if values else name)
+    return '>'.join(descriptions)
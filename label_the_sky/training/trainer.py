@@ -17,6 +17,7 @@ from tensorflow.keras.layers import Input, Dense, Dropout, GlobalAveragePooling2
 from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 
+from label_the_sky.preprocessing.stats import normalize_batch
 from label_the_sky.training.callbacks import TimeHistory
 
 
@@ -153,6 +154,9 @@ class Trainer:
         X = np.load(os.path.join(
             self.data_dir,
             f'{dataset}_{channels}_X_{split}.npy'))
+        bounds_file = os.path.join(self.data_dir, f'{dataset}_{channels}_bounds.npy')
+        if os.path.exists(bounds_file):
+            X = normalize_batch(X, *np.load(bounds_file))
         if self.n_channels==5:
             X = X[:, :, :, BROAD_BANDS]
 
@@ -1,7 +1,23 @@
 import numpy as np
 import os
+import pandas as pd
 import re
 
+def is_parquet(path):
+    return path.endswith('.parquet') or os.path.isdir(path)
+
+def read_table(path, columns=None, **kwargs):
+    # parquet files or partitioned parquet folders; csv otherwise
+    if is_parquet(path):
+        return pd.read_parquet(path, columns=columns, **kwargs)
+    return pd.read_csv(path, usecols=columns, **kwargs)
+
+def write_table(df, path):
+    if is_parquet(path):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
 def glob_re(directory, pattern):
     files = os.listdir(directory)
     files = filter(re.compile(pattern).match, files)